@@ -0,0 +1,181 @@
+###
+#   Batch runner for many samples. Takes a manifest, a CSV file with one line per job and
+#   columns
+#       BC_file,SL_file,output_file[,states]
+#   (relative paths are relative to the directory of the manifest, and states is the
+#   --states file of a read count file in the sparse format) and runs the jobs with
+#   run_scarlet in a pool of worker processes. The workers import SCARLET once, and keep
+#   the gurobi environments they started in the pool of solvers.gurobi_env, so that later
+#   jobs of a worker reuse them instead of checking out the license again. The workers are
+#   not daemonic, so jobs can use --jobs to spread sigma over processes of their own.
+#
+#   A job is skipped if all its output files exist, are newer than its input files and
+#   were written with the same options (their hash is kept in the .metrics.json file), so
+#   an interrupted batch resumes where it stopped when it is run again. --force reruns all
+#   jobs. A failed job, e.g. one whose input files are missing, does not stop the batch.
+#
+#   The summary file gets one line per job as soon as it is done, with its status
+#   (done, up to date or failed), the log-likelihood, the number of copy-number states
+#   not solved to optimality, the runtime of every stage and the error of a failed job.
+#
+#   USAGE: python code/batch.py [manifest] [summary file] [options]
+###
+import os
+import sys
+import json
+import time
+import argparse
+import logging
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import pandas as pd
+
+from fileio import MATRIX_FORMATS, matrix_filename, read_in_files
+from scarlet import run_scarlet, write_result, add_solve_arguments, solve_options
+from metrics import stage, reset_metrics, get_metrics
+from cache import hash_key
+
+STAGES = ['load', 'sigma', 'descendant profiles', 'C', 'solve', 'assembly', 'ternary', 'LL']
+SUMMARY_COLUMNS = ['output_file', 'status', 'LL', 'states_not_optimal', 'runtime'] + \
+                  ['time_{}'.format(s.replace(' ', '_')) for s in STAGES] + ['error']
+
+def read_manifest(manifest_file):
+    """
+    returns list of dicts with the BC_file, SL_file, output_file and states (or None) of
+    every job, with paths relative to the directory of the manifest
+    """
+    manifest = pd.read_csv(manifest_file, dtype = str, skipinitialspace = True)
+    missing = [c for c in ['BC_file', 'SL_file', 'output_file'] if c not in manifest.columns]
+    if len(missing) > 0:
+        raise ValueError('Manifest {} has no column {}'.format(manifest_file, ', '.join(missing)))
+    if manifest['output_file'].duplicated().any():
+        raise ValueError('Manifest {} has repeated output files'.format(manifest_file))
+
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    jobs = []
+    for _, line in manifest.iterrows():
+        job = {'states': None}
+        for column in ['BC_file', 'SL_file', 'output_file', 'states']:
+            if column in manifest.columns and not pd.isna(line[column]):
+                job[column] = os.path.join(base, line[column])
+        jobs.append(job)
+    return jobs
+
+def output_files(output_file, output_format):
+    """
+    returns list of the files written by scarlet.write_result for output_file
+    """
+    return [matrix_filename('{}.{}'.format(output_file, ext), output_format) for ext in ['B', 'B_ancestor', 'T']] + \
+           ['{}.{}'.format(output_file, ext) for ext in ['LL', 'solve_report', 'metrics.json']]
+
+def options_hash(options):
+    """
+    returns the hash of the options of run_scarlet, without the cache and the number of jobs,
+    which do not change the results
+    """
+    return hash_key('options', {key: value for key, value in options.items() if key not in ['cache', 'jobs']})
+
+def is_up_to_date(job, output_format, options):
+    """
+    returns True if all output files of job exist, are newer than its input files and were
+    written with options. A job with missing input files is not up to date, so that it is
+    run and fails
+    """
+    outputs = output_files(job['output_file'], output_format)
+    inputs = [job[c] for c in ['BC_file', 'SL_file', 'states'] if job[c] is not None]
+    if not all(os.path.exists(f) for f in outputs + inputs):
+        return False
+    if min(os.path.getmtime(f) for f in outputs) < max(os.path.getmtime(f) for f in inputs):
+        return False
+    try:
+        with open(outputs[-1]) as f:
+            return json.load(f).get('options_hash') == options_hash(options)
+    except (OSError, ValueError):
+        return False
+
+def init_worker(log_level):
+    # forked workers inherit the logging configuration of the parent
+    logging.basicConfig(format = '%(message)s', stream = sys.stdout)
+    logging.getLogger().setLevel(log_level)
+
+def run_job(arguments):
+    """
+    arguments -- (job, options of run_scarlet, output format)
+
+    returns the line of the summary of job
+    """
+    job, options, output_format = arguments
+    start = time.time()
+    line = {'output_file': job['output_file']}
+    try:
+        reset_metrics()
+        with stage('load'):
+            counts, S, L = read_in_files(job['BC_file'], job['SL_file'], job['states'])
+        load_metrics = get_metrics()
+
+        result = run_scarlet(counts, S, L, **options)
+        directory = os.path.dirname(job['output_file'])
+        if directory != '':
+            os.makedirs(directory, exist_ok = True)
+        write_result(result, job['output_file'], output_format, load_metrics, options_hash(options))
+
+        timings = dict(result.timings, load = load_metrics['load']['wall_time'])
+        line.update({'status': 'done', 'LL': result.LL,
+                     'states_not_optimal': sum(r['status'] != 'optimal' for r in result.solve_reports.values())})
+        for s in STAGES:
+            line['time_{}'.format(s.replace(' ', '_'))] = timings.get(s, 0.0)
+    except Exception as e:
+        line.update({'status': 'failed', 'error': '{}: {}'.format(type(e).__name__, e)})
+        logging.getLogger(__name__).error('Job %s failed\n%s', job['output_file'], traceback.format_exc())
+    line['runtime'] = time.time() - start
+    return line
+
+def write_summary_line(line, out):
+    pd.DataFrame([line], columns = SUMMARY_COLUMNS).to_csv(out, header = False, index = False)
+    out.flush()
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Run SCARLET on the jobs of a manifest')
+    parser.add_argument('manifest', help = 'CSV file with columns BC_file,SL_file,output_file[,states]')
+    parser.add_argument('summary_file', help = 'CSV file with the status and runtime of every job')
+    parser.add_argument('--workers', type = int, default = 1, help = 'number of worker processes (default: 1)')
+    parser.add_argument('--force', action = 'store_true', help = 'also rerun the jobs whose outputs are up to date')
+    parser.add_argument('--output-format', choices = MATRIX_FORMATS, default = 'csv',
+                        help = 'format of the .B, .B_ancestor and .T files (default: csv)')
+    parser.add_argument('--log-level', choices = ['DEBUG', 'INFO', 'WARNING'], type = str.upper, default = 'WARNING',
+                        help = 'log level of the jobs (default: WARNING)')
+    add_solve_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level = 'INFO', format = '%(message)s', stream = sys.stdout)
+    options = solve_options(args)
+    jobs = read_manifest(args.manifest)
+
+    with open(args.summary_file, 'w') as out:
+        out.write(','.join(SUMMARY_COLUMNS) + '\n')
+
+        todo = []
+        for job in jobs:
+            if not args.force and is_up_to_date(job, args.output_format, options):
+                write_summary_line({'output_file': job['output_file'], 'status': 'up to date'}, out)
+            else:
+                todo.append(job)
+        logging.info('{} jobs, {} up to date'.format(len(jobs), len(jobs) - len(todo)))
+
+        # every worker keeps its imports and solver environments for all its jobs
+        with ProcessPoolExecutor(max_workers = args.workers, initializer = init_worker, initargs = (args.log_level,)) as pool:
+            futures = [pool.submit(run_job, (job, options, args.output_format)) for job in todo]
+            for k, future in enumerate(as_completed(futures)):
+                line = future.result()
+                write_summary_line(line, out)
+                logging.info('[{}/{}] {} {} ({:.2f}s)'.format(k + 1, len(todo), line['output_file'], line['status'], line['runtime']))
+
+    failed = sum(1 for line in pd.read_csv(args.summary_file)['status'] if line == 'failed')
+    if failed > 0:
+        logging.error('{} jobs failed, see {}'.format(failed, args.summary_file))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
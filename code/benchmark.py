@@ -0,0 +1,200 @@
+###
+#   Benchmark of SCARLET on the bundled data. Runs the pipeline with run_scarlet on the
+#   simulated instances in data/simulations and on data/CRC2, and writes one line per
+#   instance with the runtime and peak memory of every stage (time_[stage] and
+#   peak_rss_mb_[stage], see metrics, and their maximum peak_rss_mb), the log-likelihood
+#   of the solution and, for the simulations, its accuracy with respect to the ground
+#   truth in data/simulations/perfect_data:
+#       B_error, T_error        fraction of entries of B and of the ternary matrix that differ
+#       loss_precision/recall   of the inferred mutation losses, where a loss is a pair
+#                               (copy-number state, mutation) such that the mutation is lost
+#                               in the cells of that state but not in those of its parent
+#
+#   Every instance runs in a new process, so that its memory does not include that of
+#   the instances before it and can be compared across instances and commits. The table
+#   has the commit it was run on, so that tables of different commits can be compared
+#   with --compare.
+#
+#   Larger instances generated by simulate.py are run with --data-dir.
+#
+#   USAGE: python code/benchmark.py [output table] [options]
+###
+import os
+import sys
+import argparse
+import logging
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+from fileio import read_in_files
+from scarlet import run_scarlet, add_solve_arguments, solve_options
+from metrics import stage, reset_metrics, get_metrics
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+STAGES = ['sigma', 'descendant profiles', 'C', 'solve', 'heuristic', 'ILP build', 'ILP solve',
+          'assembly', 'ternary', 'LL']
+
+def list_instances(simulations, crc2, simulations_dir = os.path.join(DATA_DIR, 'simulations')):
+    """
+    simulations -- list of the numbers of the simulated instances
+    crc2 -- if True, also the CRC2 data
+    simulations_dir -- directory with scarlet_input/ and perfect_data/, e.g. written by simulate.py
+
+    returns list of (name, read count file, copy-number tree file, ground truth prefix or None)
+    """
+    instances = []
+    for i in simulations:
+        instances.append(('tree.{}'.format(i),
+                          os.path.join(simulations_dir, 'scarlet_input', 'tree.{}.B'.format(i)),
+                          os.path.join(simulations_dir, 'perfect_data', 'tree.{}.S'.format(i)),
+                          os.path.join(simulations_dir, 'perfect_data', 'tree.{}'.format(i))))
+    if crc2:
+        instances.append(('CRC2', os.path.join(DATA_DIR, 'CRC2', 'CRC2.csv'),
+                          os.path.join(DATA_DIR, 'CRC2', 'CRC2-L.csv'), None))
+    return instances
+
+def read_ground_truth(filename, index, columns):
+    """
+    reads a matrix of perfect_data, a line with the number of cells n, a line with the
+    number of mutations m and n lines of m space-separated entries
+
+    index, columns -- cell ids and mutation names of the rows and columns, in the order of
+                      the read count file
+
+    returns dataframe
+    """
+    with open(filename) as f:
+        n = int(f.readline())
+        m = int(f.readline())
+        values = np.loadtxt(f, dtype=int, ndmin=2)
+    if values.shape != (n, m) or values.shape != (len(index), len(columns)):
+        raise ValueError('{} has shape {}, expected {}'.format(filename, values.shape, (len(index), len(columns))))
+    return pd.DataFrame(values, index = index, columns = columns)
+
+def find_losses(T, states, S):
+    """
+    T -- ternary matrix, 2 where a mutation is lost
+    states -- copy-number state of every row of T
+
+    returns set of (state, mutation) such that the mutation is lost in the cells of the
+    state but not in the cells of its parent in the copy-number tree S
+    """
+    parent = {t: s for s, t in S}
+    lost = {}
+    for state in set(states):
+        rows = T.values[states == state]
+        lost[state] = set(T.columns[(rows == 2).any(axis=0)])
+    return set((state, a) for state in lost for a in lost[state]
+               if a not in lost.get(parent.get(state), set()))
+
+def precision_recall(inferred, true):
+    precision = len(inferred & true) / len(inferred) if len(inferred) > 0 else 1.0
+    recall = len(inferred & true) / len(true) if len(true) > 0 else 1.0
+    return precision, recall
+
+def run_instance(name, BC_file, SL_file, truth, options):
+    """
+    returns dict with the line of the table of instance name
+    """
+    reset_metrics()
+    with stage('load'):
+        counts, S, L = read_in_files(BC_file, SL_file)
+    # run_scarlet starts its own metrics
+    load_metrics = get_metrics()['load']
+    result = run_scarlet(counts, S, L, **options)
+    metrics = dict(result.metrics, load = load_metrics)
+
+    line = {'instance': name, 'cells': len(counts.cells), 'mutations': len(counts.mutations),
+            'LL': result.LL, 'time_load': load_metrics['wall_time']}
+    line['time_total'] = load_metrics['wall_time'] + sum(result.timings[stage_name] for stage_name in
+                                                         ['sigma', 'descendant profiles', 'C', 'solve', 'assembly', 'ternary', 'LL'])
+    for stage_name in STAGES:
+        line['time_{}'.format(stage_name.replace(' ', '_'))] = result.timings.get(stage_name, 0.0)
+    for stage_name in ['load'] + STAGES:
+        line['peak_rss_mb_{}'.format(stage_name.replace(' ', '_'))] = metrics.get(stage_name, {}).get('peak_rss_mb')
+    line['peak_rss_mb'] = max([m['peak_rss_mb'] or 0 for m in metrics.values()] + [0])
+    line['states_not_optimal'] = sum(report['status'] != 'optimal' for report in result.solve_reports.values())
+
+    if truth is not None:
+        # the ground truth is in the order of the read count file, which is the order of counts
+        raw_columns = pd.read_csv(BC_file, index_col=0, nrows=0).columns
+        file_mutations = [v[:-2] for v in raw_columns if v.endswith('_v')]
+        true_B = read_ground_truth('{}.B'.format(truth), counts.cells, file_mutations)[result.B.columns]
+        true_T = read_ground_truth('{}.T'.format(truth), counts.cells, file_mutations)[result.B.columns]
+        line['B_error'] = (result.B.loc[counts.cells].values != true_B.values).mean()
+        line['T_error'] = (result.ternary.loc[counts.cells].values != true_T.values).mean()
+        line['loss_precision'], line['loss_recall'] = precision_recall(
+            find_losses(result.ternary.loc[counts.cells], counts.states, S),
+            find_losses(true_T, counts.states, S))
+    return line
+
+def init_process():
+    logging.basicConfig(level = 'WARNING', format = '%(message)s', stream = sys.stdout)
+
+def run_instance_in_new_process(name, BC_file, SL_file, truth, options):
+    """
+    returns run_instance in a newly started Python process
+    """
+    with ProcessPoolExecutor(max_workers = 1, mp_context = multiprocessing.get_context('spawn'),
+                             initializer = init_process) as pool:
+        return pool.submit(run_instance, name, BC_file, SL_file, truth, options).result()
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(__file__)),
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def compare_tables(table, previous):
+    """
+    prints the instances whose log-likelihood or accuracy changed with respect to the table
+    previous, and the ratio of the total runtimes
+    """
+    merged = table.merge(previous, on = 'instance', suffixes = ('', '_previous'))
+    for column in ['LL', 'B_error', 'T_error', 'loss_precision', 'loss_recall']:
+        if column not in merged or column + '_previous' not in merged: continue
+        changed = ~np.isclose(merged[column], merged[column + '_previous'], rtol = 1e-9, atol = 1e-9, equal_nan = True)
+        for _, line in merged[changed].iterrows():
+            print('CHANGED {} {}: {} -> {}'.format(line['instance'], column, line[column + '_previous'], line[column]))
+    print('Total runtime {:.2f}s, previous {:.2f}s (commit {})'.format(
+        merged['time_total'].sum(), merged['time_total_previous'].sum(), merged['commit_previous'].iloc[0]
+        if len(merged) > 0 else 'unknown'))
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Benchmark SCARLET on the simulations and CRC2')
+    parser.add_argument('output_file', help = 'table with one line per instance (CSV)')
+    parser.add_argument('--simulations', type = int, nargs = '*', default = list(range(50)),
+                        help = 'numbers of the simulated instances (default: all 50)')
+    parser.add_argument('--no-crc2', action = 'store_true', help = 'do not run CRC2')
+    parser.add_argument('--data-dir', default = os.path.join(DATA_DIR, 'simulations'),
+                        help = 'directory of the simulated instances, e.g. generated by simulate.py (default: data/simulations)')
+    parser.add_argument('--compare', default = None,
+                        help = 'table of an earlier run, e.g. of another commit, to compare to')
+    add_solve_arguments(parser)
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    logging.basicConfig(level = 'WARNING', format = '%(message)s', stream = sys.stdout)
+    options = solve_options(args)
+    commit = current_commit()
+
+    lines = []
+    for name, BC_file, SL_file, truth in list_instances(args.simulations, not args.no_crc2, args.data_dir):
+        line = run_instance_in_new_process(name, BC_file, SL_file, truth, options)
+        line['commit'] = commit
+        print('{} -- LL {:.4f}, B error {}, {:.2f}s'.format(name, line['LL'], line.get('B_error', 'NA'), line['time_total']))
+        lines.append(line)
+
+    table = pd.DataFrame(lines)
+    table.to_csv(args.output_file, index = False)
+
+    if args.compare is not None:
+        compare_tables(table, pd.read_csv(args.compare))
+
+if __name__ == '__main__':
+    main()
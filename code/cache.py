@@ -0,0 +1,145 @@
+###
+#   Content-addressed on-disk cache of intermediate results, so that re-running a sample
+#   after a small change of its inputs reuses the stages whose inputs did not change.
+#   Entries are pickles named by the SHA-256 hash of everything the result depends on
+#   (see hash_key), so an entry is never stale: a changed input gives a different key.
+#
+#   The total size of the cache directory is bounded. When an entry is written, the least
+#   recently used entries are removed until the cache fits, where the modification time of
+#   an entry is updated every time it is read. Several processes can share a cache
+#   directory, e.g. the workers of batch.py, as entries are written atomically.
+#
+#   Entries are pickles, so only use cache directories that you trust.
+###
+import os
+import pickle
+import hashlib
+import logging
+import threading
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from scipy.sparse import issparse
+
+logger = logging.getLogger(__name__)
+
+# part of every key, to be increased when the format of cached results changes
+CACHE_VERSION = 2
+
+DiskCache = namedtuple('DiskCache', ['directory', 'max_bytes'])
+
+def open_cache(directory, max_mb):
+    """
+    returns the DiskCache in directory, which is created if needed, holding at most max_mb MB
+    """
+    os.makedirs(directory, exist_ok = True)
+    return DiskCache(directory = directory, max_bytes = int(max_mb * 1024 * 1024))
+
+def _hash_update(h, part):
+    if isinstance(part, pd.DataFrame):
+        h.update(b'F')
+        for p in [part.index, part.columns, part.values]:
+            _hash_update(h, p)
+    elif isinstance(part, pd.Index):
+        _hash_update(h, list(part))
+    elif issparse(part):
+        part = part.tocsr()
+        h.update(b'S')
+        for p in [part.shape, part.data, part.indices, part.indptr]:
+            _hash_update(h, p)
+    elif isinstance(part, np.ndarray):
+        if part.dtype == object:
+            _hash_update(h, list(part))
+        else:
+            h.update('A{}{}'.format(part.dtype.str, part.shape).encode())
+            h.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (list, tuple)):
+        h.update('L{}'.format(len(part)).encode())
+        for p in part:
+            _hash_update(h, p)
+    elif isinstance(part, dict):
+        h.update('D{}'.format(len(part)).encode())
+        for key in sorted(part, key = repr):
+            _hash_update(h, key)
+            _hash_update(h, part[key])
+    elif part is None or isinstance(part, (str, bool, int, float, np.generic)):
+        h.update('V{};'.format(repr(part)).encode())
+    else:
+        raise TypeError('Cannot hash {} for the cache'.format(type(part).__name__))
+
+def hash_key(*parts):
+    """
+    parts -- strings, numbers, numpy arrays, scipy sparse matrices, dataframes, and lists,
+             tuples and dicts of these
+
+    returns the hex SHA-256 digest of parts
+    """
+    h = hashlib.sha256('scarlet cache {}'.format(CACHE_VERSION).encode())
+    _hash_update(h, list(parts))
+    return h.hexdigest()
+
+def _entry_file(cache, key):
+    return os.path.join(cache.directory, '{}.pkl'.format(key))
+
+def cache_get(cache, key):
+    """
+    returns the entry of key, or None if it is not in the cache
+    """
+    filename = _entry_file(cache, key)
+    try:
+        with open(filename, 'rb') as f:
+            value = pickle.load(f)
+        os.utime(filename)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    return value
+
+def cache_put(cache, key, value):
+    """
+    writes value as the entry of key, and removes the least recently used entries until the
+    cache holds at most cache.max_bytes
+    """
+    filename = _entry_file(cache, key)
+    temporary = '{}.{}.{}.tmp'.format(filename, os.getpid(), threading.get_ident())
+    with open(temporary, 'wb') as f:
+        pickle.dump(value, f, protocol = pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary, filename)
+    evict(cache)
+
+def evict(cache):
+    entries = []
+    for name in os.listdir(cache.directory):
+        if not name.endswith('.pkl'): continue
+        try:
+            stat = os.stat(os.path.join(cache.directory, name))
+        except OSError:
+            # removed by another process
+            continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries):
+        if total <= cache.max_bytes:
+            break
+        try:
+            os.remove(os.path.join(cache.directory, name))
+            logger.debug('Cache: evicted %s', name)
+        except OSError:
+            pass
+        total -= size
+
+def cached(cache, parts, compute):
+    """
+    returns compute() for the inputs parts, from the cache if it has it, and stores it
+    otherwise. Without a cache (None) this is compute()
+    """
+    if cache is None:
+        return compute()
+    key = hash_key(*parts)
+    value = cache_get(cache, key)
+    if value is None:
+        value = compute()
+        cache_put(cache, key, value)
+    else:
+        logger.info('Cache: reusing {}'.format(parts[0]))
+    return value
@@ -1,11 +1,159 @@
+import os
 import pandas as pd
+import numpy as np
+import json
+from collections import namedtuple
+from scipy.sparse import csr_matrix, issparse
 
-def read_in_files(input_file, state_tree_file):
-    BC = pd.read_csv(input_file, index_col=0)
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+###
+#   Read counts of all cells, as used by the optimization.
+#       V, T        variant and total read counts, unsigned integer arrays (cells x mutations).
+#                   Read from the sparse format they are scipy.sparse csr matrices instead,
+#                   which only store the entries with reads
+#       states      integer array with the copy-number state of every cell
+#       cells       pandas Index of the cell ids, giving the row of a cell with get_loc/get_indexer
+#       mutations   pandas Index of the sorted mutation names, giving the column of a mutation
+###
+ReadCounts = namedtuple('ReadCounts', ['V', 'T', 'states', 'cells', 'mutations'])
+
+def read_counts_from_dataframe(BC):
+    """
+    BC -- dataframe in the format of the read count file, indexed by cell id, with the
+          copy-number state in column c and columns [mut]_v and [mut]_t for every mutation
+
+    returns ReadCounts
+    """
+    mutations = sorted(set([v[:-2] for v in BC.columns if v.endswith('_v') or v.endswith('_t')]))
+    V = BC[['{}_v'.format(a) for a in mutations]].values
+    T = BC[['{}_t'.format(a) for a in mutations]].values
+    if (T < V).any():
+        raise ValueError('Variant read counts larger than total read counts')
+    dtype = count_dtype(T.ravel())
+
+    return ReadCounts(V = V.astype(dtype), T = T.astype(dtype), states = BC['c'].values.astype(int),
+                      cells = pd.Index(map(str, BC.index)), mutations = pd.Index(mutations))
+
+def count_dtype(T):
+    return np.uint16 if len(T) == 0 or np.max(T) <= np.iinfo(np.uint16).max else np.uint32
+
+def read_sparse_counts(input_file, states_file):
+    """
+    input_file -- comma-separated file with header cell_id,mutation,v,t and one line for
+                  every cell and mutation with reads. Missing lines have no reads
+    states_file -- comma-separated file with header cell_id,c giving the copy-number state
+                   of every cell
+
+    returns ReadCounts with sparse V and T
+    """
+    states = pd.read_csv(states_file, dtype = {'cell_id': str})
+    entries = pd.read_csv(input_file, dtype = {'cell_id': str, 'mutation': str})
+    cells = pd.Index(states['cell_id'].values)
+    if cells.has_duplicates:
+        raise ValueError('Cells with more than one copy-number state in {}'.format(states_file))
+    if entries.duplicated(['cell_id', 'mutation']).any():
+        raise ValueError('Cells with more than one line for the same mutation in {}'.format(input_file))
+    if (entries['t'] < entries['v']).any():
+        raise ValueError('Variant read counts larger than total read counts')
+    mutations = pd.Index(sorted(entries['mutation'].unique()))
+
+    # entries without reads do not change any likelihood and are not stored
+    entries = entries[entries['t'] > 0]
+    rows = cells.get_indexer(entries['cell_id'])
+    if (rows < 0).any():
+        raise ValueError('Cells without a copy-number state in {}'.format(states_file))
+    cols = mutations.get_indexer(entries['mutation'])
+
+    dtype = count_dtype(entries['t'].values)
+    shape = (len(cells), len(mutations))
+    V = csr_matrix((entries['v'].values.astype(dtype), (rows, cols)), shape = shape)
+    T = csr_matrix((entries['t'].values.astype(dtype), (rows, cols)), shape = shape)
+    return ReadCounts(V = V, T = T, states = states['c'].values.astype(int), cells = cells, mutations = mutations)
+
+def counts_block(counts, rows, columns):
+    """
+    returns (V, T), the dense arrays of read counts of the given rows and columns of counts
+    """
+    if issparse(counts.T):
+        return counts.V[rows][:, columns].toarray(), counts.T[rows][:, columns].toarray()
+    return counts.V[np.ix_(rows, columns)], counts.T[np.ix_(rows, columns)]
+
+def read_in_files(input_file, state_tree_file, states_file=None):
+    """
+    input_file -- read count file, or read counts in the sparse format of read_sparse_counts
+                  if states_file is given
+    states_file -- copy-number states of the cells for the sparse format
+
+    returns (counts, S, L) where counts is ReadCounts, S is the edge list of the
+    copy-number tree and L maps every edge to its list of supported losses
+    """
+    if states_file is None:
+        counts = read_counts_from_dataframe(pd.read_csv(input_file, index_col=0))
+    else:
+        counts = read_sparse_counts(input_file, states_file)
+    S, L = read_state_tree(state_tree_file)
+    return counts, S, L
+
+###
+#   Out-of-core reading of the read count file. The file is read in chunks of
+#   rows (cells), so that the whole table is never in memory at once. While it is read
+#   the first time, the cells are also split by copy-number state into binary files,
+#   from which the cells of one state are loaded at a time.
+###
+def iter_read_counts(input_file, chunksize):
+    """
+    yields ReadCounts of consecutive chunks of chunksize cells of the read count file
+    """
+    for BC in pd.read_csv(input_file, index_col=0, chunksize=chunksize):
+        yield read_counts_from_dataframe(BC)
+
+def split_state_counts(chunks, directory, files):
+    """
+    Splits the cells of the chunks by copy-number state on the way, so that the cells of
+    every state can be loaded by load_state_counts without reading the file again
+
+    chunks -- iterable of ReadCounts of disjoint sets of cells, e.g. from iter_read_counts
+    directory -- directory that gets one file with the read counts of every state in every chunk
+    files -- dict that gets the list of the files of every copy-number state
+
+    yields the chunks
+    """
+    for k, counts in enumerate(chunks):
+        for state in np.unique(counts.states):
+            keep = counts.states == state
+            filename = os.path.join(directory, 'state{}.chunk{}.npz'.format(state, k))
+            np.savez(filename, V = counts.V[keep], T = counts.T[keep], cells = np.asarray(counts.cells[keep], dtype=str))
+            files.setdefault(state, []).append(filename)
+        yield counts
+
+def load_state_counts(files, state, mutations):
+    """
+    files -- list of the files of the cells in copy-number state state from split_state_counts
+    mutations -- pandas Index of the mutations of the chunks
+
+    returns ReadCounts of only the cells in copy-number state state
+    """
+    V, T, cells = [], [], []
+    for filename in files:
+        with np.load(filename) as data:
+            V.append(data['V'])
+            T.append(data['T'])
+            cells.append(data['cells'].astype(object))
+    cells = np.concatenate(cells)
+    return ReadCounts(V = np.concatenate(V), T = np.concatenate(T), states = np.full(len(cells), state),
+                      cells = pd.Index(cells), mutations = mutations)
+
+def read_state_tree(state_tree_file):
+    """
+    returns (S, L) where S is the edge list of the copy-number tree and L maps every edge
+    to its list of supported losses
+    """
     S = []
     L = {}
-    mutations = set(sorted([v.split('_')[0] for v in BC.columns[1:]]))
-    BC.index = map(str, BC.index)
 
     with open(state_tree_file) as f:
         for line in f:
@@ -17,12 +165,103 @@ def read_in_files(input_file, state_tree_file):
             except:
                 L[tuple(edge)] = []
 
-    return BC, S, L
+    return S, L
+
+###
+#   Mutation matrices (.B, .B_ancestor, .T) can be written as CSV, as Parquet (needs pyarrow)
+#   or as compressed NPZ with arrays values, index and columns. The binary formats keep the
+#   integer dtype and get the extension .parquet or .npz after the usual one.
+###
+MATRIX_FORMATS = ['csv', 'parquet', 'npz']
+
+def matrix_filename(filename, fmt):
+    return filename if fmt == 'csv' else '{}.{}'.format(filename, fmt)
+
+def write_matrix(M, filename, fmt='csv'):
+    """
+    M -- dataframe with string index and columns
+    fmt -- one of MATRIX_FORMATS
+
+    writes M to matrix_filename(filename, fmt)
+    """
+    filename = matrix_filename(filename, fmt)
+    if fmt == 'csv':
+        M.to_csv(filename)
+    elif fmt == 'parquet':
+        if pyarrow is None:
+            raise ImportError('pyarrow is not installed, use the csv or npz format instead')
+        M.to_parquet(filename)
+    elif fmt == 'npz':
+        np.savez_compressed(filename, values = M.values, index = np.asarray(M.index, dtype=str),
+                            columns = np.asarray(M.columns, dtype=str))
+    else:
+        raise ValueError('No such format: {}'.format(fmt))
+
+def read_matrix(filename):
+    """
+    reads a matrix written by write_matrix, in the format given by the extension of filename
 
-def write_out_files(B, B_with_ancestors, T, filename, totalLL):
-    B.to_csv('{}.B'.format(filename))
-    B_with_ancestors.to_csv('{}.B_ancestor'.format(filename))
-    T.to_csv('{}.T'.format(filename))
+    returns dataframe
+    """
+    if filename.endswith('.parquet'):
+        if pyarrow is None:
+            raise ImportError('pyarrow is not installed, use the csv or npz format instead')
+        return pd.read_parquet(filename)
+    elif filename.endswith('.npz'):
+        with np.load(filename) as data:
+            return pd.DataFrame(data['values'], index = data['index'].astype(object), columns = data['columns'].astype(object))
+    return pd.read_csv(filename, index_col=0)
+
+def write_out_files(B, B_with_ancestors, T, filename, totalLL, fmt='csv'):
+    write_matrix(B, '{}.B'.format(filename), fmt)
+    write_matrix(B_with_ancestors, '{}.B_ancestor'.format(filename), fmt)
+    write_matrix(T, '{}.T'.format(filename), fmt)
 
     with open('{}.LL'.format(filename), 'w') as out:
         out.write('{}\n'.format(totalLL))
+
+def write_solve_report(reports, filename):
+    """
+    reports -- dict from copy-number state to the report of optimize_mutation_matrix.solve_model
+
+    writes [filename].solve_report, one line per copy-number state with the status of its solve,
+    the objective, an upper bound on the optimal objective, the relative gap between them, the runtime,
+    the statistics of the solver (see solvers.add_solver_stats) and whether the solution was taken
+    from the cache, in which case the other columns are those of the solve that cached it
+    """
+    columns = ['cells', 'mutations', 'status', 'objective', 'bound', 'gap', 'runtime',
+               'models', 'variables', 'constraints', 'nodes', 'cached']
+    report = pd.DataFrame([reports[i] for i in reports], index = list(reports), columns = columns)
+    report.index.name = 'state'
+    report.to_csv('{}.solve_report'.format(filename))
+
+def write_LL_breakdown(LLs, filename):
+    """
+    LLs -- dataframe (cells x mutations) of the log-likelihood of every entry of the mutation matrix
+
+    writes [filename].LL_matrix with the full matrix, and [filename].LL_cells and
+    [filename].LL_mutations with its sums over mutations and over cells
+    """
+    LLs.to_csv('{}.LL_matrix'.format(filename))
+    LLs.sum(axis = 1).to_frame('LL').to_csv('{}.LL_cells'.format(filename), index_label = 'cell_id')
+    LLs.sum(axis = 0).to_frame('LL').to_csv('{}.LL_mutations'.format(filename), index_label = 'mutation')
+
+def write_metrics(stages, reports, filename, options_hash=None):
+    """
+    stages -- dict from stage name to its metrics, from metrics.get_metrics
+    reports -- dict from copy-number state to the report of optimize_mutation_matrix.solve_model
+    options_hash -- hash of the options of the run, stored as options_hash if given
+
+    writes [filename].metrics.json
+    """
+    def to_json(value):
+        # numpy scalars are not serializable by json
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError('Cannot write {} to JSON'.format(type(value)))
+
+    metrics = {'stages': stages, 'solver': {str(i): reports[i] for i in reports}}
+    if options_hash is not None:
+        metrics['options_hash'] = options_hash
+    with open('{}.metrics.json'.format(filename), 'w') as out:
+        json.dump(metrics, out, indent = 2, default = to_json)
@@ -0,0 +1,185 @@
+###
+#   Heuristics for the perfect phylogeny problem solved by
+#   optimize_mutation_matrix.solve_model. They take the score matrix C as an array
+#   (cells x mutations) and return a binary matrix without conflicting pairs of
+#   columns, i.e. a feasible but not necessarily optimal solution of the ILP.
+###
+import numpy as np
+
+def greedy_perfect_phylogeny(C, rounds = 2, B = None):
+    """
+    Thresholds C by sign and repairs three-gamete conflicts greedily. Columns are added
+    one at a time, in decreasing order of their total positive score, and each column
+    is changed with the lowest loss of score that makes it compatible with the columns
+    that were already added. Afterwards every column is taken out and added back in
+    the same way for a number of rounds, which can only increase the score.
+
+    The columns of a perfect phylogeny form a laminar family (two columns are either
+    nested or disjoint), i.e. a tree of sets. A set X is compatible with the tree if X
+    is a subset of some node A that is made of cells that are in A but in none of its
+    children, and of whole children of A. The best such X for A takes the positive
+    cells of A and the children with a positive total score, so the best compatible
+    column is found in a single pass over the tree.
+
+    C -- array of scores (cells x mutations)
+    rounds -- number of rounds of taking out and adding back every column
+    B -- binary array without conflicting columns to start the rounds from, instead
+         of adding the columns of C greedily
+
+    returns binary array B with the shape of C
+    """
+    C = np.asarray(C, dtype=float)
+    n, m = C.shape
+
+    # node 0 is the set of all cells and node j+1 is column j if it is non-empty
+    parent = {0: None}
+    children = {0: []}
+    node_of = np.zeros(n, dtype=int)     # deepest node containing each cell
+
+    def add_column(j):
+        c = C[:, j]
+        private_positive = np.bincount(node_of, weights = np.clip(c, 0, None), minlength = m + 1)
+        subtree_sum = np.bincount(node_of, weights = c, minlength = m + 1)
+
+        preorder = []
+        stack = [0]
+        while len(stack) > 0:
+            v = stack.pop()
+            preorder.append(v)
+            stack += children[v]
+        for v in reversed(preorder[1:]):
+            subtree_sum[parent[v]] += subtree_sum[v]
+
+        A = None
+        for v in preorder:
+            value = private_positive[v] + sum(max(subtree_sum[k], 0) for k in children[v])
+            if A is None or value > best: A, best = v, value
+        if best <= 0: return
+
+        chosen = [k for k in children[A] if subtree_sum[k] > 0]
+        private = (node_of == A) & (c > 0)
+        column = private.copy()
+        for k in chosen:
+            column |= B[:, k - 1] == 1
+        B[:, j] = column
+
+        parent[j + 1] = A
+        children[j + 1] = chosen
+        children[A] = [k for k in children[A] if k not in chosen] + [j + 1]
+        for k in chosen:
+            parent[k] = j + 1
+        node_of[private] = j + 1
+
+    def remove_column(j):
+        B[:, j] = 0
+        if j + 1 not in parent: return
+        A = parent.pop(j + 1)
+        for k in children[j + 1]:
+            parent[k] = A
+        children[A] = [k for k in children[A] if k != j + 1] + children.pop(j + 1)
+        node_of[node_of == j + 1] = A
+
+    order = np.argsort(-np.clip(C, 0, None).sum(axis = 0), kind = 'stable')
+    if B is None:
+        B = np.zeros((n, m), dtype=int)
+        for j in order:
+            add_column(j)
+    else:
+        B = np.array(B, dtype=int)
+        tree_order, tree_parent = mutation_tree(B)
+        for j in tree_order:
+            if B[:, j].sum() == 0: continue
+            parent[j + 1] = tree_parent[j] + 1
+            children[j + 1] = []
+            children[tree_parent[j] + 1].append(j + 1)
+            # columns come after the columns containing them, so the last one is the deepest
+            node_of[B[:, j] == 1] = j + 1
+
+    for _ in range(rounds):
+        for j in order:
+            remove_column(j)
+            add_column(j)
+
+    return B
+
+def fast_perfect_phylogeny(C, max_rounds = 10):
+    """
+    Polynomial-time approximation of the ILP, used by the fast mode of solve_model.
+
+    Starts from greedy_perfect_phylogeny. The columns of the current solution are ordered
+    by containment, which gives a tree of mutations where every column hangs below the
+    smallest column that contains it. Every cell is then assigned to the path from the
+    root of this tree with the highest score. Every perfect phylogeny on these mutations
+    assigns cells to paths in its tree, so this never decreases the score. Each column is
+    then taken out and added back as in greedy_perfect_phylogeny, and these steps are
+    repeated until the score stops increasing.
+
+    C -- array of scores (cells x mutations)
+    max_rounds -- maximum number of rounds of building the tree and assigning cells
+
+    returns binary array B with the shape of C
+    """
+    C = np.asarray(C, dtype=float)
+    B = greedy_perfect_phylogeny(C)
+    score = (B * C).sum()
+
+    for _ in range(max_rounds):
+        order, parent = mutation_tree(B)
+        B_new = best_path_assignment(C, order, parent)
+        B_new = greedy_perfect_phylogeny(C, rounds = 1, B = B_new)
+        score_new = (B_new * C).sum()
+        if score_new <= score: break
+        B, score = B_new, score_new
+
+    return B
+
+def mutation_tree(B):
+    """
+    B -- binary array (cells x mutations) without conflicting columns
+
+    returns (order, parent) where order lists the columns such that every column comes
+    after the columns that contain it, and parent[j] is the smallest column containing
+    column j, or -1 for the root. Empty columns hang from the root.
+    """
+    B = np.asarray(B) == 1
+    counts = B.sum(axis = 0)
+    order = np.argsort(-counts, kind = 'stable')
+    position = np.empty(len(order), dtype=int)
+    position[order] = np.arange(len(order))
+
+    parent = np.full(B.shape[1], -1)
+    for j in order:
+        if counts[j] == 0: continue
+        # as the columns are laminar, the columns before j containing any cell of j are
+        # the ancestors of j, and the last one of them is its parent
+        cell = np.argmax(B[:, j])
+        ancestors = [i for i in np.nonzero(B[cell])[0] if position[i] < position[j]]
+        if len(ancestors) > 0:
+            parent[j] = max(ancestors, key = lambda i: position[i])
+    return order, parent
+
+def best_path_assignment(C, order, parent):
+    """
+    Assigns every cell to the root or to the node of the mutation tree whose path from
+    the root has the highest total score in C
+
+    returns binary array B with the shape of C, the mutations on the path of each cell
+    """
+    n, m = C.shape
+    # path_score[:, j] is the score of the path from the root to column j
+    path_score = np.zeros((n, m))
+    for j in order:
+        path_score[:, j] = C[:, j] + (path_score[:, parent[j]] if parent[j] >= 0 else 0)
+
+    paths = np.zeros((m, m), dtype=int)
+    for j in order:
+        if parent[j] >= 0:
+            paths[j] = paths[parent[j]]
+        paths[j, j] = 1
+
+    B = np.zeros((n, m), dtype=int)
+    if m == 0: return B
+    best = np.argmax(path_score, axis = 1)
+    assigned = path_score[np.arange(n), best] > 0
+    B[assigned] = paths[best[assigned]]
+    return B
@@ -0,0 +1,112 @@
+###
+#   Instrumentation of the stages of SCARLET. Every stage of the pipeline is run inside
+#   stage(name), which adds up the wall time and the number of calls of the stage and
+#   measures its memory use. Stages called from the threads of
+#   optimize_mutation_matrix.solve_models add up the time of all threads.
+#
+#   The memory of a stage is measured on the resident set size (RSS) of the process,
+#   which a background thread samples every SAMPLE_INTERVAL seconds while any stage
+#   runs, and at the start and end of every stage:
+#       peak_rss_mb     highest RSS while the stage ran, over all its calls
+#       rss_delta_mb    RSS at the end minus RSS at the start, summed over all calls,
+#                       i.e. the memory the stage kept
+#   Allocations that come and go between two samples are missed, and stages that run at
+#   the same time (nested stages, or states solved in parallel) see each other's memory.
+#   The current RSS is read from /proc, so both are None where it is not available.
+#
+#   The metrics are kept per process, so run_scarlet calls reset_metrics when it starts
+#   and get_metrics when it is done.
+###
+import os
+import time
+import threading
+from contextlib import contextmanager
+
+SAMPLE_INTERVAL = 0.01
+
+_STAGES = {}
+_LOCK = threading.Lock()
+# peak RSS seen so far by every running stage, and the thread that samples it
+_ACTIVE = {}
+_SAMPLER = [None]
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):
+    _PAGE_SIZE = 4096
+
+def current_rss_mb():
+    """
+    returns the resident set size of the process in MB, or None if it is not available
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE / (1024.0 * 1024.0)
+    except (OSError, ValueError, IndexError):
+        return None
+
+def _update_active(rss):
+    # with _LOCK held
+    if rss is not None:
+        for token in _ACTIVE:
+            _ACTIVE[token] = max(_ACTIVE[token], rss)
+
+def _sample():
+    while True:
+        time.sleep(SAMPLE_INTERVAL)
+        rss = current_rss_mb()
+        with _LOCK:
+            if len(_ACTIVE) == 0:
+                _SAMPLER[0] = None
+                return
+            _update_active(rss)
+
+def _reset_after_fork():
+    # the sampler thread does not exist in a forked child
+    _ACTIVE.clear()
+    _SAMPLER[0] = None
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child = _reset_after_fork)
+
+@contextmanager
+def stage(name):
+    start = time.time()
+    start_rss = current_rss_mb()
+    token = object()
+    with _LOCK:
+        _ACTIVE[token] = start_rss if start_rss is not None else 0.0
+        if start_rss is not None and _SAMPLER[0] is None:
+            _SAMPLER[0] = threading.Thread(target = _sample, daemon = True)
+            _SAMPLER[0].start()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        end_rss = current_rss_mb()
+        with _LOCK:
+            _update_active(end_rss)
+            peak = _ACTIVE.pop(token)
+            if start_rss is None:
+                peak = None
+            delta = end_rss - start_rss if start_rss is not None and end_rss is not None else None
+            metrics = _STAGES.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'peak_rss_mb': peak,
+                                                'rss_delta_mb': None if delta is None else 0.0})
+            metrics['calls'] += 1
+            metrics['wall_time'] += elapsed
+            if peak is not None:
+                metrics['peak_rss_mb'] = max(metrics['peak_rss_mb'], peak)
+            if delta is not None:
+                metrics['rss_delta_mb'] += delta
+
+def reset_metrics():
+    with _LOCK:
+        _STAGES.clear()
+
+def get_metrics():
+    """
+    returns dict from stage name to dict with its number of calls, total wall time in
+    seconds, and the peak RSS during the stage and the RSS it kept in MB (see above)
+    """
+    with _LOCK:
+        return {name: dict(metrics) for name, metrics in _STAGES.items()}
@@ -1,152 +1,390 @@
-from gurobipy import *
 import pandas as pd
+import numpy as np
+from scipy.sparse import coo_matrix
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from threading import Lock
+import time
+import logging
+from scipy.sparse.csgraph import connected_components
 
 from optimize_sigma import get_optimal_sigma
-from probmodels import log_prob_present, log_prob_absent
+from probmodels import log_prob_absent_present_arrays
+from fileio import counts_block
+from solvers import SOLVERS, find_conflicting_pairs, add_solver_stats
+from heuristics import fast_perfect_phylogeny
+from metrics import stage
+from cache import hash_key, cache_get, cache_put
+
+logger = logging.getLogger(__name__)
 
 EPSILON = -0.00001
+# default relative MIP gap of gurobi and HiGHS. Solves that stop with a larger gap, e.g.
+# at --mip-gap, are reported with status mip_gap instead of optimal
+OPTIMALITY_GAP = 1e-4
 
-def solve_model(C):
+def solve_model(C, solver='gurobi', lazy=False, decompose=False, threads=None, warm_start=False,
+                mode='exact', report_gap=False, deadline=None, mip_gap=None, report=None):
 
     """
     C -- pandas dataframe with columns correspondng to mutations and rows corresponding to cells
+    solver -- name of the ILP backend in SOLVERS used to find B
+    lazy -- if True, start without three-gamete constraints and only add them for the
+            pairs of mutations that conflict in the solution, re-solving until there are none
+    decompose -- if True, fix trivial columns, merge identical columns and solve the
+                 connected components of the conflict graph as separate models
+    threads -- maximum number of threads the solver may use, solver default if None
+    warm_start -- if True, every model starts from the solution of fast_perfect_phylogeny,
+                  which is also kept if the solver does not find anything better
+    mode -- 'exact' to solve the ILP, or 'fast' to use the polynomial-time
+            fast_perfect_phylogeny instead
+    report_gap -- in fast mode, also solve the ILP and report the gap to its objective
+    deadline -- time (as given by time.time()) at which solving stops and the best solution
+                found so far is returned. Models are always warm started with a deadline,
+                so that there is a solution to return
+    mip_gap -- relative MIP gap at which the solver stops, solver default if None. Like the
+               objective in the report it leaves out the entries of the ANC: rows that
+               are fixed anyway, see fixed_objective
+    report -- dict that gets the status, objective, upper bound on the objective, relative
+              gap and runtime of the solve
+
+    returns (B, deletions) where B is the optimal mutation matrix with the same shape as C
     """
+    if mode not in ['exact', 'fast']:
+        raise ValueError('No such mode: {}'.format(mode))
     try:
-        vals = []
-        # Create a new model
-        m = Model("mip1")
-
-        Bs = {}
-        # Create mutation matrix
-        for p in C.index:
-            for a in C.columns:
-                Bs[(p,a)] = m.addVar(vtype=GRB.BINARY, name="b_{}_{}".format(p,a))
-                vals.append((p,a))
-
-        for i,a in enumerate(C.columns):
-            for b in C.columns[i+1:]:
-
-                x = m.addVar(vtype=GRB.BINARY, name="x_{}_{}".format(a,b))
-                y = m.addVar(vtype=GRB.BINARY, name="y_{}_{}".format(a,b))
-                z = m.addVar(vtype=GRB.BINARY, name="z_{}_{}".format(a,b))
-
-                m.addConstr(x+y+z <= 2)
-
-                Xps = []
-                Yps = []
-                Zps = []
-
-                for p in C.index:
-                    x_p = m.addVar(vtype=GRB.BINARY, name = "x_{}_{}_{}".format(p,a,b))
-                    y_p = m.addVar(vtype=GRB.BINARY, name = "y_{}_{}_{}".format(p,a,b))
-                    z_p = m.addVar(vtype=GRB.BINARY, name = "z_{}_{}_{}".format(p,a,b))
-
-                    m.addConstr(x_p >= Bs[(p,a)] + Bs[(p,b)] -1)
-                    m.addConstr(y_p >= (1-Bs[(p,a)]) + Bs[(p,b)] -1)
-                    m.addConstr(z_p >= Bs[(p,a)] + (1-Bs[(p,b)]) -1)
-
-                    m.addConstr(x_p <= Bs[(p,a)])
-                    m.addConstr(x_p <= Bs[(p,b)])
-
-                    m.addConstr(y_p <= 1-Bs[(p,a)])
-                    m.addConstr(y_p <= Bs[(p,b)])
-
-                    m.addConstr(z_p <= Bs[(p,a)])
-                    m.addConstr(z_p <= 1-Bs[(p,b)])
-
-                    m.addConstr(x >= x_p)
-                    m.addConstr(y >= y_p)
-                    m.addConstr(z >= z_p)
-
-                    Xps.append(x_p)
-                    Yps.append(y_p)
-                    Zps.append(z_p)
-
-                m.addConstr(x <= sum(Xps))
-                m.addConstr(y <= sum(Yps))
-                m.addConstr(z <= sum(Zps))
-
-
-
-        # Set objective
-        objn = sum(Bs[(p,a)]*C.loc[p][a] for p,a in vals)
-
-        m.setObjective(objn, GRB.MAXIMIZE)
-
-        m.optimize()
-
-        B = C.copy()
-        for v in m.getVars():
-            if v.varName.startswith('b'):
-                try:
-                    p,a = v.varName.split('_')[1:]
-                except:
-                    print(v.varName)
-                    raise
-                B.loc[p][a] = v.x
-
-        
-        print("Optimized B --------------------")
-        print(B)
+        backend = SOLVERS[solver]
+    except KeyError:
+        raise ValueError('No such solver: {}'.format(solver))
+
+    def solve(C, pairs=None, start=None, info=None):
+        time_limit = None if deadline is None else deadline - time.time()
+        return backend(C, pairs, threads = threads, start = start, time_limit = time_limit,
+                       mip_gap = mip_gap, offset = fixed_objective(C), info = info)
+
+    if warm_start or deadline is not None:
+        solve = partial(solve_model_warm_start, solve = solve)
+
+    if lazy:
+        solve_full = partial(solve_model_lazy, solve = solve, deadline = deadline)
+    else:
+        solve_full = solve
+
+    if decompose:
+        solve_exact = partial(solve_model_decomposed, solve = solve_full, deadline = deadline)
+    else:
+        solve_exact = solve_full
+
+    start_time = time.time()
+    info = {}
+    fixed = fixed_objective(C)
+    if mode == 'fast':
+        B = heuristic_solution(C)
+        objective = (B.values * C.values).sum() - fixed
+        # every entry of B contributes at most max(C, 0), so this bounds the ILP objective
+        info['status'] = 'heuristic'
+        info['bound'] = np.clip(C.values, 0, None).sum()
+        logger.info("FAST MODE: objective {}, upper bound {}".format(objective, info['bound'] - fixed))
+        if report_gap:
+            exact_info = {}
+            exact_objective = (solve_exact(C, info = exact_info).values * C.values).sum() - fixed
+            info['bound'] = min(info['bound'], exact_info['bound'])
+            logger.info("FAST MODE: ILP objective {}, gap {}".format(exact_objective, relative_gap(objective, exact_objective)))
+            for key in ['models', 'variables', 'constraints', 'nodes']:
+                info[key] = exact_info.get(key, 0)
+    else:
+        B = solve_exact(C, info = info)
+
+    if report is not None:
+        objective = (B.values * C.values).sum() - fixed
+        # the solver may have no bound if it stopped early, then sum(max(C, 0)) is used
+        bound = min(info['bound'], np.clip(C.values, 0, None).sum()) - fixed
+        gap = relative_gap(objective, bound)
+        status = info['status']
+        if status == 'optimal' and gap > OPTIMALITY_GAP:
+            status = 'mip_gap'
+        report.update({'cells': C.shape[0], 'mutations': C.shape[1], 'status': status,
+                       'objective': objective, 'bound': bound,
+                       'gap': gap, 'runtime': time.time() - start_time,
+                       'models': info.get('models', 0), 'variables': info.get('variables', 0),
+                       'constraints': info.get('constraints', 0), 'nodes': info.get('nodes', 0)})
+
+    logger.debug("Optimized B --------------------\n%s", B)
+
+    deletions = output_with_deletions(C,B)
+    return B, deletions
+
+
+def fixed_objective(C):
+    """
+    returns the part of the objective of C that every sensible solution has, the sum of
+    the entries of the ANC: rows that force a mutation to be present (see calculate_C).
+    Objectives and bounds are reported without it, so that their gap is that of the
+    cells, and not close to 0 because of the large entries of the ANC: rows
+    """
+    ancestors = np.array([str(v).startswith('ANC:') for v in C.index], dtype=bool)
+    return np.clip(C.values[ancestors], 0, None).sum()
 
-        deletions = output_with_deletions(C,m)
-        return B, deletions
-        #print('Obj:', m.objVal)
+def relative_gap(objective, best):
+    """
+    returns the gap of objective to the better objective (or bound) best, relative to best
+    """
+    return abs(best - objective) / max(abs(best), 1e-10)
 
-    except GurobiError:
-        print('Error reported')
-        raise
+def solve_models(Cs, threads=None, time_limit=None, reports=None, cache=None, **options):
+    """
+    Solves the models of several copy-number states at the same time. The models are
+    independent, so up to threads of them are solved concurrently, and the thread budget
+    is divided between the concurrent solves. The largest models start first so that
+    they don't finish last.
+
+    Cs -- dict from copy-number state to C
+    threads -- total number of threads used by all solves. If None the states are
+               solved one at a time with the solver's default number of threads
+    time_limit -- total wall-clock time in seconds for all solves. Every state gets a
+                  share of the remaining time proportional to its size when it starts, but
+                  at least the average of its proportional and its equal share of the whole
+                  time_limit, so that small states get enough time to be solved. No state
+                  gets time past the end of time_limit, states that start after it get
+                  the heuristic solution
+    reports -- dict that gets the report of solve_model for every copy-number state, with
+               'cached' True if it was taken from the cache
+    cache -- cache.DiskCache of the solutions, keyed by C and options. Only solutions that
+             do not depend on the time limit (status optimal, mip_gap or heuristic) are stored
+    options -- keyword arguments of solve_model
+
+    returns dict from copy-number state to (B, deletions), the same as solving
+    the states one after the other
+    """
+    results = {}
+    if cache is not None:
+        keys = {i: hash_key('solve', Cs[i], options) for i in Cs}
+        for i in Cs:
+            entry = cache_get(cache, keys[i])
+            if entry is not None:
+                results[i], report = entry
+                if reports is not None:
+                    reports[i] = dict(report, cached = True)
+        logger.info("Cache: reusing the solutions of {} of {} states".format(len(results), len(Cs)))
+
+    order = sorted([i for i in Cs if i not in results], key = lambda i: Cs[i].size, reverse = True)
+    if threads is None:
+        workers = 1
+        solver_threads = None
+    else:
+        workers = max(1, min(threads, len(order)))
+        solver_threads = max(1, threads // workers)
+
+    deadline = None if time_limit is None else time.time() + time_limit
+    # every state gets some time, even if it has no mutations
+    weight = {i: Cs[i].size + 1 for i in order}
+    total_weight = sum(weight.values())
+    pending_weight = [total_weight]
+    lock = Lock()
+
+    def solve_state(i):
+        state_deadline = None
+        if deadline is not None:
+            with lock:
+                now = time.time()
+                share = (deadline - now) * weight[i] / pending_weight[0]
+                pending_weight[0] -= weight[i]
+            minimum_share = time_limit * (weight[i] / total_weight + 1.0 / len(order)) / 2
+            state_deadline = min(now + max(share, minimum_share), deadline)
+        report = {}
+        result = solve_model(Cs[i], threads = solver_threads, deadline = state_deadline, report = report, **options)
+        if cache is not None and report['status'] in ['optimal', 'mip_gap', 'heuristic']:
+            cache_put(cache, keys[i], (result, report))
+        if reports is not None:
+            reports[i] = dict(report, cached = False)
+        return result
+
+    with ThreadPoolExecutor(max_workers = workers) as pool:
+        futures = {i: pool.submit(solve_state, i) for i in order}
+        results.update({i: futures[i].result() for i in order})
+    if reports is not None:
+        # the reports were added as the states finished, put them in the order of Cs
+        ordered = {i: reports.pop(i) for i in Cs if i in reports}
+        reports.update(ordered)
+    return {i: results[i] for i in Cs}
+
+def heuristic_solution(C):
+    """
+    returns the solution of fast_perfect_phylogeny for C as a dataframe, which is the
+    fast mode, the start of warm-started models and what is used when the deadline passes
+    """
+    with stage('heuristic'):
+        return pd.DataFrame(fast_perfect_phylogeny(C.values).astype(float), index = C.index, columns = C.columns)
 
+def solve_model_warm_start(C, pairs=None, solve=None, info=None):
+    """
+    Solves the model starting from the heuristic solution of fast_perfect_phylogeny,
+    and returns whichever of the two has the higher objective
+    """
+    start = heuristic_solution(C).values
+    start_objective = (start * C.values).sum()
+    logger.info("WARM START: heuristic objective {}".format(start_objective))
+
+    B = solve(C, pairs, start = start, info = info)
+    objective = (B.values * C.values).sum()
+    logger.info("WARM START: solver objective {}".format(objective))
+    if objective < start_objective:
+        B = pd.DataFrame(start.astype(float), index = C.index, columns = C.columns)
+    return B
+
+def solve_model_lazy(C, solve, deadline=None, info=None):
+    """
+    Solves the model with three-gamete constraints only for the pairs of mutations
+    that conflict. Every round solves with the current pairs and adds the pairs whose
+    columns contain all three gametes. The relaxation is exact once no pair conflicts,
+    so the result is an optimal solution of the full model.
 
-def output_with_deletions(C,m):
+    If the deadline passes while pairs still conflict, the heuristic solution of
+    fast_perfect_phylogeny is returned instead.
+    """
+    if info is None: info = {}
+    pairs = (np.zeros(0, dtype=int), np.zeros(0, dtype=int))
+    while True:
+        B = solve(C, pairs, info = info)
+        conflicts = find_conflicting_pairs(B.values)
+        logger.info("LAZY CONSTRAINTS: {} pairs, {} conflicting".format(len(pairs[0]), len(conflicts[0])))
+        if len(conflicts[0]) == 0:
+            return B
+        if deadline is not None and time.time() >= deadline:
+            # the bound of the relaxation is still a bound of the full model
+            logger.warning("LAZY CONSTRAINTS: out of time, using the heuristic solution")
+            info['status'] = 'time_limit'
+            return heuristic_solution(C)
+        pairs = (np.concatenate([pairs[0], conflicts[0]]), np.concatenate([pairs[1], conflicts[1]]))
+
+###
+#   Problem reduction and decomposition. Columns whose scores are all >= 0 (all <= 0)
+#   are set to all ones (zeros), which never conflict with another column. Identical
+#   columns are merged into one with the summed scores, as an optimal solution can
+#   always give them the same values. The remaining columns are split into the
+#   connected components of the conflict graph of the matrix thresholded by sign,
+#   and each component is solved as its own model. Components whose solutions
+#   conflict with each other are merged and solved again, so that the merged matrix
+#   is an optimal solution of the full model.
+#
+#   The models of the components together are a relaxation of the full model, so the
+#   sum of their bounds bounds the full model. Once the deadline has passed, components
+#   that are not solved yet get the heuristic solution of fast_perfect_phylogeny instead,
+#   and if components still conflict, that of the full model is returned.
+###
+def solve_model_decomposed(C, solve, deadline=None, info=None):
+    if info is None: info = {}
+    values = C.values
+    n, m = values.shape
+    B = np.zeros((n, m))
+
+    free = []
+    for j in range(m):
+        if (values[:, j] >= 0).all():
+            B[:, j] = 1
+        elif not (values[:, j] <= 0).all():
+            free.append(j)
+
+    # merge identical columns
+    groups = {}
+    for j in free:
+        groups.setdefault(values[:, j].tobytes(), []).append(j)
+    groups = list(groups.values())
+    merged = pd.DataFrame(np.stack([values[:, g[0]] * len(g) for g in groups], axis=1) if groups else np.zeros((n, 0)),
+                          index = C.index, columns = [C.columns[g[0]] for g in groups])
+    logger.info("DECOMPOSITION: {} of {} columns fixed, {} merged columns".format(m - len(free), m, len(groups)))
+
+    edges = find_conflicting_pairs(merged.values > 0)
+    solutions = {}
+    while True:
+        graph = coo_matrix((np.ones(len(edges[0])), edges), shape = (len(groups), len(groups)))
+        num_components, labels = connected_components(graph, directed = False)
+
+        B_merged = np.zeros(merged.shape)
+        info['status'] = 'optimal'
+        info['bound'] = (B * values).sum()
+        for component in range(num_components):
+            columns = np.nonzero(labels == component)[0]
+            key = tuple(columns)
+            if key not in solutions:
+                component_info = {}
+                if len(columns) == 1:
+                    component_B = (merged.values[:, columns] > 0).astype(float)
+                    component_info['status'] = 'optimal'
+                    component_info['bound'] = (component_B * merged.values[:, columns]).sum()
+                elif deadline is not None and time.time() >= deadline:
+                    component_B = heuristic_solution(merged.iloc[:, columns]).values
+                    component_info['status'] = 'time_limit'
+                    component_info['bound'] = np.clip(merged.values[:, columns], 0, None).sum()
+                else:
+                    component_B = solve(merged.iloc[:, columns], info = component_info).values
+                    add_solver_stats(info, component_info['variables'], component_info['constraints'],
+                                     component_info['nodes'], component_info['models'])
+                solutions[key] = (component_B, component_info)
+            B_merged[:, columns], component_info = solutions[key]
+            info['bound'] += component_info['bound']
+            if component_info['status'] != 'optimal':
+                info['status'] = component_info['status']
+
+        conflicts = find_conflicting_pairs(B_merged)
+        logger.info("DECOMPOSITION: {} components, {} conflicting pairs between them".format(num_components, len(conflicts[0])))
+        if len(conflicts[0]) == 0:
+            break
+        if deadline is not None and time.time() >= deadline:
+            logger.warning("DECOMPOSITION: out of time, using the heuristic solution")
+            info['status'] = 'time_limit'
+            return heuristic_solution(C)
+        edges = (np.concatenate([edges[0], conflicts[0]]), np.concatenate([edges[1], conflicts[1]]))
+
+    for i, g in enumerate(groups):
+        B[:, g] = B_merged[:, [i]]
+
+    return pd.DataFrame(B, index = C.index, columns = C.columns)
+
+def output_with_deletions(C,B):
     deletions = []
-    print("C COLUMNS", C.columns)
-    print(C)
+    logger.debug("C COLUMNS %s\n%s", list(C.columns), C)
     for v in C.index:
         if v.startswith('ANC:'):
             for c in C.columns:
                 if C.loc[v][c] == EPSILON: 
-                    value =  m.getVarByName("b_{}_{}".format(v, c)).x
+                    value =  B.loc[v][c]
                     if value == 1: 
-                        print("DELETION DETECTED", v,c)
+                        logger.info("DELETION DETECTED {} {}".format(v,c))
                         deletions.append((v,c))
-                    print("---------------------------------------------------------------- EPSILON")
     return deletions
     #raise Exception()
 
 
 
-def calculate_C(c, sigmas, DPs, BC):
+def calculate_C(c, sigmas, DPs, counts):
     # For each copy-number state, we consider take the subet of mutations 
     # that are mixed in that copy-number state
     
     mixed_muts = [a for a in sigmas if sigmas[a][c]=='Mixed']
 
-    C = pd.DataFrame()
-    for a in mixed_muts:
-        C[a] = BC[BC['c']==c].apply(lambda x: calc_c_observed_cell(x['{}_v'.format(a)], \
-               x['{}_t'.format(a)]), axis=1)
+    cells = np.nonzero(counts.states == c)[0]
+    columns = counts.mutations.get_indexer(mixed_muts)
+    V, T = counts_block(counts, cells, columns)
+    C = pd.DataFrame(calc_c_observed_cells(V, T), index = counts.cells[cells], columns = mixed_muts)
     
-    print("MIXED MUTS FOR STATE {}: {}".format(c, mixed_muts))
+    logger.debug("MIXED MUTS FOR STATE {}: {}".format(c, mixed_muts))
     def desc_scores(v):
-        print(v)
         if v == 1: return 100000
         elif v == 0: return -100000
         else: 
             global EPSILON
-            print("------------------------------", EPSILON)
             return EPSILON
     
 
     try:
         descs = DPs[c]
-        print("----------------- DESCS", descs)
+        logger.debug("DESCS %s", descs)
     except KeyError:
         descs=[]
 
     for i,D in enumerate(descs):
         child, desc = D
-        print(child)
         d = pd.DataFrame([[desc_scores(desc[a]) for a in mixed_muts]], columns = mixed_muts,\
             index = ['ANC:{}'.format(child)])
         C = pd.concat([C,d])
@@ -155,27 +393,28 @@ def calculate_C(c, sigmas, DPs, BC):
     #C = C.reset_index(drop = True)
     return C
         
-def calc_c_observed_cell(v,t):
-    return log_prob_present(v,t) - log_prob_absent(v,t)
+def calc_c_observed_cells(V,T):
+    log_absent, log_present = log_prob_absent_present_arrays(V,T)
+    return log_present - log_absent
 
 def get_descendent_profiles(sigmas, mutations, S, L):
     DPs = {}
-    print(L)
+    logger.debug("SUPPORTED LOSSES %s", L)
     for edge in S:
         parent, child = edge
-        print(edge, L[tuple(edge)])
+        logger.debug("EDGE %s %s", edge, L[tuple(edge)])
         child_status = {m:sigmas[m][child] for m in mutations}
 
         parent_status = {m:sigmas[m][parent] for m in mutations}
 
-        print("child status", child_status)
-        print("parent status", parent_status)
+        logger.debug("child status %s", child_status)
+        logger.debug("parent status %s", parent_status)
         child_founder_profile = {m:1 if child_status[m] == 'Present' and parent_status[m] in ['Mixed', 'Present'] \
                                  else 0 for m in mutations}
         descendent_profile = {m:1 if child_founder_profile[m] == 1 else '?' if m in L[tuple(edge)] \
                               and parent_status[m] in ['Mixed', 'Present'] else 0 for m in mutations}
 
-        print([descendent_profile[v] for v in descendent_profile])
+        logger.debug("descendent profile %s", [descendent_profile[v] for v in descendent_profile])
         if parent not in DPs:
             DPs[parent] = []
         DPs[parent].append((child, descendent_profile)) 
@@ -184,68 +423,59 @@ def get_descendent_profiles(sigmas, mutations, S, L):
 
     return DPs 
 
-def assemble_mutation_matrix(Bs,sigmas, BC, mutations):
+###
+#   Assembly of the full mutation matrix. Mutations that are Absent or Present in a
+#   copy-number state are 0 or 1 in all cells of that state, which is a broadcast of
+#   the rows of sigma over the states of the cells. The Mixed mutations of each state
+#   are then filled in from the solution of its ILP as one block.
+###
+def sigma_present_matrix(sigmas, states, mutations):
+    """
+    sigmas -- dataframe of the status of every mutation (columns) in every copy-number state (rows)
+    states -- array with the copy-number state of every row of the result
+
+    returns int8 array (rows x mutations), 1 where the mutation is Present in the state of the row
+    """
+    present = (sigmas.loc[:, mutations] == 'Present').values.astype(np.int8)
+    return present[sigmas.index.get_indexer(states)]
+
+def scatter_block(B_tot, index, columns, B):
+    """
+    writes the values of dataframe B into the array B_tot, whose rows and columns are
+    labelled by the pandas indexes index and columns
+    """
+    rows = index.get_indexer(B.index)
+    cols = columns.get_indexer(B.columns)
+    B_tot[np.ix_(rows, cols)] = np.round(B.values).astype(np.int8)
+
+def assemble_mutation_matrix(Bs,sigmas, counts, mutations):
 
     # Bs give partial information and sigmas assemble the rest
-    B_tot = pd.DataFrame(columns = mutations, index = BC.index)
-    #print(mutations)
-    #print(Bs)
+    B_tot = sigma_present_matrix(sigmas, counts.states, mutations)
+    index = counts.cells
+    columns = pd.Index(mutations)
 
     for i in Bs:
-
         B = Bs[i]
-        for p in B.index:
-            v = B.loc[p]
-            if p.startswith('ANC:'): continue
-            for a in B.columns:
-                B_tot.loc[p][a] = int(v[a])
-
-        status = sigmas.loc[i]
-        cells = BC[BC['c'] == i].index
-
-        for cell in cells:
-            for a in status.index:
-                if status[a] == 'Absent':
-                    B_tot.loc[cell][a] = 0
-                elif status[a] == 'Present':
-                    B_tot.loc[cell][a] = 1
+        B = B[~B.index.str.startswith('ANC:')]
+        scatter_block(B_tot, index, columns, B)
 
-    return B_tot
-
-def assemble_mutation_matrix_with_ancestors(Bs,sigmas, BC, mutations):
+    return pd.DataFrame(B_tot, index = index, columns = mutations)
 
-    
-    index = []
-    for i in Bs:
-            index+=Bs[i].index.tolist()
-            print(Bs[i].index)
+def assemble_mutation_matrix_with_ancestors(Bs,sigmas, counts, mutations):
 
+    # every row of the ILP of a state, observed cells and ancestors, is in that state
+    index = pd.Index([p for i in Bs for p in Bs[i].index])
+    states = np.concatenate([np.full(len(Bs[i].index), i) for i in Bs]) if len(Bs) > 0 else np.zeros(0, dtype=int)
 
     # Bs give partial information and sigmas assemble the rest
-    B_tot = pd.DataFrame(columns = ["CN"]+ mutations, index = index)
-    #B_tot = pd.DataFrame(columns = mutations, index = index)
-
+    B_tot = sigma_present_matrix(sigmas, states, mutations)
+    columns = pd.Index(mutations)
     for i in Bs:
+        scatter_block(B_tot, index, columns, Bs[i])
 
-        B = Bs[i]
-        for p in B.index:
-            v = B.loc[p]
-            #if p.startswith('d'): continue
-            for a in B.columns:
-                B_tot.loc[p][a] = int(v[a])
-
-        status = sigmas.loc[i]
-        #cells = BC[BC['c'] == i].index
-        cells = B.index
-
-        for cell in cells:
-            #B_tot["CN"]=i
-            B_tot.loc[cell]['CN'] = i
-            for a in status.index:
-                if status[a] == 'Absent':
-                    B_tot.loc[cell][a] = 0
-                elif status[a] == 'Present':
-                    B_tot.loc[cell][a] = 1
+    B_tot = pd.DataFrame(B_tot, index = index, columns = mutations)
+    B_tot.insert(0, 'CN', states)
     return B_tot
 
 
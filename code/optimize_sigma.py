@@ -1,11 +1,18 @@
 
-from probmodels import log_prob_absent, log_prob_present, log_prob_mixed
+from probmodels import log_prob_absent_array, log_prob_present_array, log_prob_mixed_array, log_prob_arrays, nonzero_entries
+from scipy.sparse import issparse
+from fileio import ReadCounts
 import pandas as pd
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
 
 ###
 #   Calculates the optimal sigma assignments for all mutations given state tree S
 ###
-def get_optimal_sigma(S, BC, L):
+def get_optimal_sigma(S, counts, L, method='dp', jobs=1, state_LLs=None):
     """
     For all mutations calculates the optimal sigma assignment
     S -- edgelist representation of copy-number state tree
@@ -13,55 +20,51 @@ def get_optimal_sigma(S, BC, L):
     Note that there's an inherent assumption about C that the copy-number states are 
     continuous integers starting at 0
 
-    BC -- pandas dataframe input matrix
+    counts -- fileio.ReadCounts of the input
+    method -- 'dp' to find the optimal coloring with a dynamic program over S, or
+              'enumerate' to score every rooted subtree of S (reference implementation)
+    jobs -- number of worker processes the mutations are spread over, if state_LLs is
+            None. Every worker computes the state_LLs of its own mutations from their read
+            counts. Given state_LLs only the dynamic program is left, which is not worth
+            the worker processes, so they are not used then
+    state_LLs -- the result of get_state_log_likelihoods for counts if it was already
+                 computed, e.g. by stream_state_log_likelihoods. Then counts.V and
+                 counts.T are not used
 
     returns dataframe with columns corresponding to mutations and rows corresponding to
     copy-number states, and entries in {'Absent', 'Present', 'Mixed'}
 
     """
-    mutations = set(sorted([v.split('_')[0] for v in BC.columns[1:]]))
-    C = list(BC['c'])
+    C = counts.states
     num_states = len(set(C))
-    subtrees = enum_all_subtrees(num_states, S)
+    if method not in ['dp', 'enumerate']:
+        raise ValueError('No such method: {}'.format(method))
 
-    sigmas = {}
-    print(L)
+    mutation_list = list(counts.mutations)
+
+    logger.debug("SUPPORTED LOSSES %s", L)
+
+    if state_LLs is None and jobs > 1:
+        # Mutations are independent, so they are split into contiguous chunks of columns
+        # and the results concatenated back in sorted mutation order
+        chunks = [chunk for chunk in np.array_split(np.arange(len(mutation_list)), jobs) if len(chunk) > 0]
+        with ProcessPoolExecutor(max_workers = jobs) as pool:
+            futures = []
+            for chunk in chunks:
+                columns = slice(chunk[0], chunk[-1] + 1)
+                futures.append(pool.submit(optimal_sigma_counts_chunk, mutation_list[columns], counts.V[:, columns],
+                                           counts.T[:, columns], C, num_states, S, L, method))
+            results = []
+            for future in futures:
+                results += future.result()
+    else:
+        if state_LLs is None:
+            state_LLs = get_state_log_likelihoods(counts.V, counts.T, C, num_states)
+        results = optimal_sigma_chunk(mutation_list, state_LLs, S, L, method)
 
+    sigmas = {}
     deletions = []
-    for mutation in mutations:
-        max_value = float('-inf')
-        max_sigma = None
-        max_deletions = None
-        V = list(BC['{}_v'.format(mutation)])
-        T = list(BC['{}_t'.format(mutation)])
-        for subtree in subtrees:
-
-            status1 = ['Mixed' if i == subtree[0] else 'Present' if i in subtree[1:] else 'Absent' for i in range(num_states)]
-            
-            # S is the edge list
-            # For every edge, I need to check that if I go from present to absent
-            # then there is an allowed loss
-            valid_tree = True
-            tree_deletions = []
-            for edge in S:
-                s,t = edge
-                status_s = status1[s]
-                status_t = status1[t]
-                if status_s == 'Present' and status_t == 'Absent':
-                    if mutation not in L[tuple(edge)]: 
-                        valid_tree = False
-                    else:
-                        tree_deletions.append(('ANC:{}'.format(t), mutation))
-                    
-            if not valid_tree: continue
-                
-            p1 = log_prob_sigma(V,T,C, status1)
-
-            if p1 > max_value:
-                max_value = p1
-                max_sigma = status1
-                max_deletions = tree_deletions
-    
+    for mutation, max_sigma, max_deletions in results:
         deletions += max_deletions
         sigmas[mutation] = max_sigma
 
@@ -70,11 +73,223 @@ def get_optimal_sigma(S, BC, L):
     # Reindex columns of dataframe to be in alphabetical order
     sigma_new = sigma_new.reindex(sorted(sigma_new.columns), axis=1)
 
-    print("SIGMA")
-    print(sigma_new)
+    logger.debug("SIGMA\n%s", sigma_new)
 
     return sigma_new, deletions
 
+###
+#   Per-state sufficient statistics for sigma. A cell's contribution to the
+#   probability of sigma only depends on its copy-number state and on the
+#   status of that state, so these are summed once per state and status.
+###
+STATUSES = ['Absent', 'Present', 'Mixed']
+
+def get_state_log_likelihoods(V, T, C, num_states):
+    """
+    V,T -- arrays or scipy.sparse matrices of shape (n, m) (num cells, num mutations) of
+           variant and total reads
+    C -- list of length n of copy-number state assignments
+    num_states -- number of copy-number states k
+
+    returns array of shape (m, k, 3) whose entry [j, s, l] is the summed log probability
+    of the cells in state s for mutation j under status STATUSES[l]
+    """
+    C = np.asarray(C)
+    if issparse(T):
+        # only the entries with reads contribute, summed into their (mutation, state)
+        rows, cols, v, t = nonzero_entries(V, T)
+        m = T.shape[1]
+        bins = cols * num_states + C[rows]
+        return np.stack([np.bincount(bins, weights = LL, minlength = m * num_states).reshape(m, num_states)
+                         for LL in log_prob_arrays(v, t)], axis=2)
+
+    membership = np.zeros((num_states, len(C)))
+    membership[C, np.arange(len(C))] = 1
+
+    state_LLs = np.stack([membership.dot(LL) for LL in log_prob_arrays(V, T)], axis=2)
+    return state_LLs.transpose(1, 0, 2)
+
+def score_sigma(mutation_LLs, sigma):
+    """
+    mutation_LLs -- array of shape (k, 3) from get_state_log_likelihoods for one mutation
+    sigma -- list of length k whose entries are in {'Absent', 'Present', 'Mixed'}
+
+    returns log probability for sigma, same as log_prob_sigma
+    """
+    try:
+        status = [STATUSES.index(s) for s in sigma]
+    except ValueError:
+        raise Exception('No such status in: {}'.format(sigma))
+    return mutation_LLs[np.arange(len(sigma)), status].sum()
+
+def stream_state_log_likelihoods(chunks):
+    """
+    Accumulates the result of get_state_log_likelihoods over the chunks of cells of
+    fileio.iter_read_counts, so that only one chunk of read counts is in memory at a time
+
+    chunks -- iterable of ReadCounts of disjoint sets of cells with the same mutations
+
+    returns (counts, state_LLs) where counts is a ReadCounts of all cells without read
+    counts (V and T are None) and state_LLs is the array of get_state_log_likelihoods
+    """
+    cells, states = [], []
+    state_LLs = None
+    for chunk in chunks:
+        num_states = chunk.states.max() + 1 if len(chunk.states) > 0 else 0
+        if state_LLs is None:
+            mutations = chunk.mutations
+            state_LLs = np.zeros((len(mutations), 0, len(STATUSES)))
+        elif not chunk.mutations.equals(mutations):
+            raise ValueError('Chunks of read counts with different mutations')
+        if num_states > state_LLs.shape[1]:
+            state_LLs = np.pad(state_LLs, ((0, 0), (0, num_states - state_LLs.shape[1]), (0, 0)))
+        state_LLs[:, :num_states] += get_state_log_likelihoods(chunk.V, chunk.T, chunk.states, num_states)
+        cells.append(chunk.cells)
+        states.append(chunk.states)
+    if state_LLs is None:
+        raise ValueError('No read counts')
+
+    counts = ReadCounts(V = None, T = None, states = np.concatenate(states),
+                        cells = cells[0].append(cells[1:]), mutations = mutations)
+    return counts, state_LLs
+
+def optimal_sigma_chunk(mutations, state_LLs, S, L, method):
+    """
+    Finds the optimal sigma of every mutation in a list, used as the unit of work
+    of get_optimal_sigma
+
+    mutations -- list of length m of mutation names
+    state_LLs -- array of shape (m, k, 3) from get_state_log_likelihoods for these mutations
+
+    returns list of (mutation, sigma, deletions) in the order of mutations
+    """
+    num_states = state_LLs.shape[1]
+    if method == 'enumerate':
+        subtrees = enum_all_subtrees(num_states, S)
+
+    results = []
+    for j, mutation in enumerate(mutations):
+        if method == 'dp':
+            max_sigma, max_deletions = optimal_sigma_dp(mutation, state_LLs[j], S, L)
+        else:
+            max_sigma, max_deletions = optimal_sigma_enumerate(mutation, state_LLs[j], subtrees, S, L)
+        results.append((mutation, max_sigma, max_deletions))
+    return results
+
+def optimal_sigma_counts_chunk(mutations, V, T, C, num_states, S, L, method):
+    """
+    Same as optimal_sigma_chunk, with the state_LLs of the mutations computed from
+    their read counts, the columns V and T of the read counts
+    """
+    return optimal_sigma_chunk(mutations, get_state_log_likelihoods(V, T, C, num_states), S, L, method)
+
+###
+#   Finds the optimal sigma for one mutation. A valid sigma colors a single
+#   state Mixed, a connected set of its descendants Present and all other states
+#   Absent, where every Present -> Absent edge must be a supported loss.
+###
+def get_sigma_deletions(mutation, sigma, S, L):
+    """
+    returns (valid, deletions) where valid tells whether every Present -> Absent
+    edge of S is a supported loss of mutation in L, and deletions lists those losses
+    """
+    valid_tree = True
+    tree_deletions = []
+    for edge in S:
+        s,t = edge
+        if sigma[s] == 'Present' and sigma[t] == 'Absent':
+            if mutation not in L[tuple(edge)]:
+                valid_tree = False
+            else:
+                tree_deletions.append(('ANC:{}'.format(t), mutation))
+    return valid_tree, tree_deletions
+
+def optimal_sigma_enumerate(mutation, mutation_LLs, subtrees, S, L):
+    """
+    Scores every coloring given by subtrees (see enum_all_subtrees)
+
+    returns (sigma, deletions) for the best valid coloring
+    """
+    num_states = len(mutation_LLs)
+    max_value = float('-inf')
+    max_sigma = None
+    max_deletions = None
+    for subtree in subtrees:
+        status1 = ['Mixed' if i == subtree[0] else 'Present' if i in subtree[1:] else 'Absent' for i in range(num_states)]
+
+        valid_tree, tree_deletions = get_sigma_deletions(mutation, status1, S, L)
+        if not valid_tree: continue
+
+        p1 = score_sigma(mutation_LLs, status1)
+
+        if p1 > max_value:
+            max_value = p1
+            max_sigma = status1
+            max_deletions = tree_deletions
+    return max_sigma, max_deletions
+
+def optimal_sigma_dp(mutation, mutation_LLs, S, L):
+    """
+    Dynamic program over the state tree S, O(k) for k copy-number states.
+
+    For every state v, absent[v] is the score of its subtree with all states Absent
+    and present[v] the best score of its subtree with v Present, where a child can
+    only be left Absent if the loss of mutation on that edge is supported.
+    The Mixed state r is chosen to maximize
+        (all states Absent) - absent[r] + LL(r, Mixed) + sum_c max(present[c], absent[c])
+
+    Ties are broken towards the smaller Mixed state and towards Absent children.
+
+    returns (sigma, deletions) for the best valid coloring
+    """
+    num_states = len(mutation_LLs)
+    children = {i: [] for i in range(num_states)}
+    has_parent = set()
+    for s,t in S:
+        children[s].append(t)
+        has_parent.add(t)
+
+    # post-order traversal so that children are handled before their parents
+    order = []
+    stack = [i for i in range(num_states) if i not in has_parent]
+    while len(stack) > 0:
+        v = stack.pop()
+        order.append(v)
+        stack += children[v]
+    order.reverse()
+
+    absent = {}
+    present = {}
+    include = {}
+    for v in order:
+        absent[v] = mutation_LLs[v][0] + sum(absent[c] for c in children[v])
+        present[v] = mutation_LLs[v][1]
+        for c in children[v]:
+            include[(v,c)] = mutation not in L[(v,c)] or present[c] > absent[c]
+            present[v] += present[c] if include[(v,c)] else absent[c]
+
+    total_absent = sum(absent[v] for v in children if v not in has_parent)
+    max_value = float('-inf')
+    max_root = None
+    for r in range(num_states):
+        value = total_absent - absent[r] + mutation_LLs[r][2] + \
+                sum(max(present[c], absent[c]) for c in children[r])
+        if value > max_value:
+            max_value = value
+            max_root = r
+
+    sigma = ['Absent'] * num_states
+    sigma[max_root] = 'Mixed'
+    stack = [c for c in children[max_root] if present[c] > absent[c]]
+    while len(stack) > 0:
+        v = stack.pop()
+        sigma[v] = 'Present'
+        stack += [c for c in children[v] if include[(v,c)]]
+
+    valid_tree, deletions = get_sigma_deletions(mutation, sigma, S, L)
+    assert valid_tree
+    return sigma, deletions
+
 ###
 #   Calculates the probability of a given sigma for one mutation
 ###
@@ -91,20 +306,20 @@ def log_prob_sigma(V,T,C,sigma):
     returns log probability for sigma
     """
 
+    V = np.asarray(V)
+    T = np.asarray(T)
+    status = np.asarray(sigma, dtype=object)[np.asarray(C)]
+    for s in set(status):
+        if s not in ['Absent', 'Present', 'Mixed']:
+            raise Exception('No such status: {}'.format(s))
+
     log_prob = 0
-    for i,R in enumerate(zip(V,T,C)):
-        # print('-------')
-        v,t,c = R
-
-        status = sigma[c]
-        if status == 'Absent':
-            log_prob += log_prob_absent(v,t)
-        elif status == 'Present':
-            log_prob += log_prob_present(v,t)
-        elif status == 'Mixed':
-            log_prob += log_prob_mixed(v,t)
-        else:
-            raise Exception('No such status: {}'.format(status))
+    absent = status == 'Absent'
+    present = status == 'Present'
+    mixed = status == 'Mixed'
+    log_prob += log_prob_absent_array(V[absent], T[absent]).sum()
+    log_prob += log_prob_present_array(V[present], T[present]).sum()
+    log_prob += log_prob_mixed_array(V[mixed], T[mixed]).sum()
     return log_prob
 
 
@@ -122,8 +337,8 @@ def enum_all_subtrees(num_states, S):
 
     return all_subtrees
 
-def enum_rooted_subtrees(subtree, edgelist, frontier, treelist = []):
-    if len(treelist) == 0: treelist = [subtree]
+def enum_rooted_subtrees(subtree, edgelist, frontier, treelist = None):
+    if treelist is None: treelist = [subtree]
     while len(frontier) > 0:
         edge = frontier.pop()
         frontier_new = frontier + [(s,t) for s,t in edgelist[:] if s == edge[1]]
@@ -2,7 +2,12 @@ from __future__ import print_function
 
 # read in results file
 import sys
-import pandas as pd
+import subprocess
+import shutil
+import logging
+from fileio import read_matrix
+
+logger = logging.getLogger(__name__)
 
 ###
 # Sorts columns such that if mutation i is ancestral to mutation j, then i < j
@@ -90,7 +95,7 @@ def construct_perfect_phylogeny(result, cn_state, vertex_state):
         tree[prefix[-1]].append(cell_id)
     return tree, vertex_state
 
-def identify_mutation_losses(result):
+def identify_mutation_losses(result, cn_states):
     ## A mutation is lost if it is present in the ancestor and not in the root
     ## It is not in the root if it is not in any of the parents
     mutation_losses = {}
@@ -138,7 +143,7 @@ def construct_full_tree(result, cn_tree):
         #global_tree['CELL:d{}'.format(j)] = ['ROOT:{}'.format(j)]
     return global_tree, subtrees, vertex_state
 
-def write_out_tree(global_tree, tree_file):
+def write_out_tree(global_tree, tree_file, vertex_colors):
     with open(tree_file, 'w') as out:
         for key in global_tree:
             children = global_tree[key]
@@ -150,7 +155,7 @@ def write_out_tree(global_tree, tree_file):
 
 def read_inputs():
     if len(sys.argv) < 5:
-        print("USAGE: plot_tree.py output_file.B_ancestor [CN Tree file] [plotting style] [output prefix]")
+        print("USAGE: plot_tree.py output_file.B_ancestor[.parquet|.npz] [CN Tree file] [plotting style] [output prefix]")
     output_file = sys.argv[1]
     tree_file = sys.argv[2]
     plotting_style = sys.argv[3].upper()
@@ -158,7 +163,7 @@ def read_inputs():
 
     if plotting_style not in ['ALL', 'COUNT', 'NONE']:
         raise ValueError
-    result = pd.read_table(output_file, sep=',', index_col=0)
+    result = read_matrix(output_file)
     cn_tree = []
     with open(tree_file) as f:
         for line in f:
@@ -238,23 +243,48 @@ def output_dot_file(output_prefix, result, global_tree, vertex_colors, cn_states
         out.write('}\n')
 
 
-if __name__ == "__main__":
-
+def write_tree_files(result_matrix, cn_tree, output_prefix, draw_leaves):
+    """
+    result_matrix -- mutation matrix with ancestors and column CN, as from
+                     assemble_mutation_matrix_with_ancestors or read from [prefix].B_ancestor
+    cn_tree -- edge list of the copy-number tree
+    draw_leaves -- plotting style in {'ALL', 'COUNT', 'NONE'}
 
-    result_matrix, cn_tree, output_prefix, draw_leaves = read_inputs()
+    writes [output_prefix].edgelist and [output_prefix].dot, and returns the name of the DOT file
+    """
+    result_matrix = result_matrix.copy()
     result_matrix.columns = ['MUT:{}'.format(v) if v != 'CN' else v for v in result_matrix.columns ]
-    result_matrix['CELL_ID'] = ['CELL:{}'.format(v) if 'ANC:' not in v else v for v in result_matrix.index]
+    result_matrix['CELL_ID'] = ['CELL:{}'.format(v) if 'ANC:' not in v else v for v in map(str, result_matrix.index)]
     result_matrix = result_matrix.set_index('CELL_ID')
 
     global_tree, subtrees, vertex_colors = construct_full_tree(result_matrix, cn_tree)
 
     tree_filename = "{}.edgelist".format(output_prefix)
-    print("Outputting edgelist to {}".format(tree_filename))
-    write_out_tree(global_tree, tree_filename)
+    logger.info("Outputting edgelist to {}".format(tree_filename))
+    write_out_tree(global_tree, tree_filename, vertex_colors)
     cn_states = result_matrix['CN'].unique()
-    mutation_losses = identify_mutation_losses(result_matrix)
+    mutation_losses = identify_mutation_losses(result_matrix, cn_states)
     dot_filename = "{}.dot".format(output_prefix)
-    print("Outputting DOT file to {}".format(dot_filename))
+    logger.info("Outputting DOT file to {}".format(dot_filename))
     output_dot_file(output_prefix, result_matrix, global_tree, vertex_colors, cn_states, draw_leaves, mutation_losses)
+    return dot_filename
 
+def render_dot_file(dot_filename, output_filename):
+    """
+    renders the DOT file as PDF with GraphViz, or only prints a message if GraphViz is not installed
 
+    returns True if the PDF was written
+    """
+    if shutil.which('dot') is None:
+        logger.warning("GraphViz (dot) not found, not rendering {}".format(dot_filename))
+        return False
+    logger.info("Rendering {} to {}".format(dot_filename, output_filename))
+    subprocess.run(['dot', '-Tpdf', dot_filename, '-o', output_filename], check = True)
+    return True
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level = 'INFO', format = '%(message)s', stream = sys.stdout)
+    result_matrix, cn_tree, output_prefix, draw_leaves = read_inputs()
+    write_tree_files(result_matrix, cn_tree, output_prefix, draw_leaves)
@@ -1,10 +1,12 @@
 import pandas as pd
+import numpy as np
 
 PROB_SEQ_ERROR = 0.001
 BETABINOM_ALPHA = 1.0
 BETABINOM_BETA = 1.0
 
 from scipy.stats import betabinom, binom
+from scipy.sparse import issparse
 import math
 # Calculating the optimal sigma
 
@@ -21,26 +23,105 @@ def log_prob_mixed(v,t):
     #print(v,t, 'MIXED:', math.exp(prob), math.exp(log_prob_absent(v,t)), math.exp(log_prob_present(v,t)))
     return prob
 
-def compute_LL_solution(BC, result, mutations):
-    print(BC)
-    print(result)
+###
+#   Vectorized versions of the log probabilities above. These take arrays of
+#   variant and total read counts of any (matching) shape and return an array
+#   of the same shape. Read depths repeat a lot, so the log-pmf values are
+#   computed once per distinct (v,t) pair, found through the integer key
+#   t * (max(v) + 1) + v of every pair.
+###
+def log_prob_absent_present_arrays(V, T):
+    """
+    V,T -- arrays of variant and total read counts
 
-    def helper(x,v,t):
-        if x == 0:
-            return log_prob_absent(v,t)
-        elif x == 1:
-            return log_prob_present(v,t)
+    returns a pair of arrays (log_absent, log_present) with the shape of V
+    """
+    V = np.asarray(V)
+    T = np.asarray(T)
+    if V.size == 0:
+        return np.zeros(V.shape), np.zeros(V.shape)
+    v_range = int(V.max()) + 1
+    keys = T.ravel().astype(np.int64) * v_range + V.ravel()
 
+    num_keys = int(keys.max()) + 1
+    if num_keys <= 4 * keys.size:
+        # few possible keys, mark the ones that occur instead of sorting
+        occurs = np.zeros(num_keys, dtype=bool)
+        occurs[keys] = True
+        unique_keys = np.flatnonzero(occurs)
+        inverse = (np.cumsum(occurs) - 1)[keys]
+    else:
+        unique_keys, inverse = np.unique(keys, return_inverse=True)
 
-    totalLL = 0
-    LLs = pd.DataFrame()
-    for mutation in mutations:
-        Vs = BC['{}_v'.format(mutation)]
-        Ts = BC['{}_t'.format(mutation)]
-        
-        LLs[mutation] = pd.DataFrame(result[mutation]).apply(lambda x: helper(x[mutation], Vs[x.name], Ts[x.name]), axis=1)
-        totalLL += sum(LLs[mutation])
+    t, v = np.divmod(unique_keys, v_range)
+    log_absent = binom.logpmf(v, t, PROB_SEQ_ERROR)[inverse].reshape(V.shape)
+    log_present = betabinom.logpmf(v, t, BETABINOM_ALPHA, BETABINOM_BETA)[inverse].reshape(V.shape)
+    return log_absent, log_present
 
-    return totalLL
+def nonzero_entries(V, T):
+    """
+    V,T -- arrays or scipy.sparse matrices of variant and total read counts
+
+    returns (rows, cols, v, t), the positions and read counts of the entries with t > 0.
+    Entries without reads have probability 1 under every model, so they can be skipped
+    """
+    if issparse(T):
+        T = T.tocoo()
+        keep = T.data > 0
+        rows, cols = T.row[keep], T.col[keep]
+        v = np.asarray(V.tocsr()[rows, cols]).ravel()
+        return rows, cols, v, T.data[keep]
+    rows, cols = np.nonzero(np.asarray(T) > 0)
+    return rows, cols, np.asarray(V)[rows, cols], np.asarray(T)[rows, cols]
+
+def log_prob_absent_array(V, T):
+    return log_prob_absent_present_arrays(V, T)[0]
+
+def log_prob_present_array(V, T):
+    return log_prob_absent_present_arrays(V, T)[1]
+
+def log_prob_mixed_array(V, T):
+    return log_prob_arrays(V, T)[2]
 
+def log_prob_arrays(V, T):
+    """
+    returns the tuple (log_absent, log_present, log_mixed) of arrays for V,T
+    """
+    log_absent, log_present = log_prob_absent_present_arrays(V, T)
+    # log(0.5 * P_absent + 0.5 * P_present) in log-sum-exp form, so that high
+    # read depths do not underflow
+    log_mixed = np.logaddexp(log_absent, log_present) + math.log(0.5)
+    return log_absent, log_present, log_mixed
 
+def compute_LL_matrix(counts, result, mutations):
+    """
+    counts -- fileio.ReadCounts of the input
+    result -- binary mutation matrix (cells x mutations), with cells in counts.cells
+
+    returns dataframe (cells x mutations) of the log-likelihood of every entry of result,
+    log_prob_present where it is 1 and log_prob_absent where it is 0
+    """
+    rows = counts.cells.get_indexer(result.index)
+    columns = counts.mutations.get_indexer(mutations)
+    present = result[mutations].values == 1
+
+    if issparse(counts.T):
+        LLs = np.zeros(present.shape)
+        r, c, v, t = nonzero_entries(counts.V[rows][:, columns], counts.T[rows][:, columns])
+        log_absent, log_present = log_prob_absent_present_arrays(v, t)
+        LLs[r, c] = np.where(present[r, c], log_present, log_absent)
+    else:
+        log_absent, log_present = log_prob_absent_present_arrays(counts.V[np.ix_(rows, columns)], counts.T[np.ix_(rows, columns)])
+        LLs = np.where(present, log_present, log_absent)
+    return pd.DataFrame(LLs, index = result.index, columns = mutations)
+
+def compute_LL_solution(counts, result, mutations, return_matrix=False):
+    """
+    returns the total log-likelihood of the mutation matrix result, and also the matrix of
+    compute_LL_matrix if return_matrix is True
+    """
+    LLs = compute_LL_matrix(counts, result, mutations)
+    totalLL = LLs.values.sum()
+    if return_matrix:
+        return totalLL, LLs
+    return totalLL
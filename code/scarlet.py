@@ -1,67 +1,284 @@
-from fileio import read_in_files, write_out_files
-from optimize_sigma import get_optimal_sigma
-from optimize_mutation_matrix import get_descendent_profiles, calculate_C, solve_model, assemble_mutation_matrix, assemble_mutation_matrix_with_ancestors
+from fileio import MATRIX_FORMATS, read_in_files, read_state_tree, read_counts_from_dataframe, iter_read_counts, split_state_counts, load_state_counts, write_out_files, write_solve_report, write_LL_breakdown, write_metrics
+from optimize_sigma import get_optimal_sigma, get_state_log_likelihoods, stream_state_log_likelihoods
+from optimize_mutation_matrix import get_descendent_profiles, calculate_C, solve_models, assemble_mutation_matrix, assemble_mutation_matrix_with_ancestors
 import pandas as pd
-from probmodels import compute_LL_solution 
+import numpy as np
+from solvers import SOLVERS
+from probmodels import compute_LL_solution, compute_LL_matrix
+from plot_tree import write_tree_files, render_dot_file
+from metrics import stage, reset_metrics, get_metrics
+from cache import open_cache, hash_key, cached
 
+import argparse
+import logging
 import sys
-def correct_ternary_matrix(B, S, BC, deletions):
-    T = B.copy()
-    
+import tempfile
+from collections import namedtuple
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+def descendant_states(S, state):
+    """
+    returns the list of state and all copy-number states below it in the tree S
+    """
+    children = {}
+    for s,t in S:
+        children.setdefault(s, []).append(t)
+    states = [state]
+    for s in states:
+        states += [t for t in children.get(s, []) if t not in states]
+    return states
+
+def correct_ternary_matrix(B, S, counts, deletions):
+    """
+    B -- binary mutation matrix (cells x mutations)
+    deletions -- list of (ANC:state, mutation) pairs of mutations lost on the edge into state
+
+    returns the ternary matrix, B with a 2 wherever the mutation was lost in the state of the
+    cell or in one of its ancestors
+    """
+    states = sorted(set(counts.states) | set(s for edge in S for s in edge))
+    state_row = {s:k for k,s in enumerate(states)}
+    columns = pd.Index(B.columns)
+
+    # deleted[s, a] is True if mutation a was lost in state s or above it
+    deleted = np.zeros((len(states), len(columns)), dtype=bool)
     for deletion in deletions:
-        print("  ----", deletion)
+        logger.debug("DELETION %s", deletion)
         child, mut = deletion
         child = int(child.replace('ANC:', ''))
-        # calculate the set of copy-number states affected by the deletion
-        # not the most efficient way to do this but S should be small
-        set_states = [child]
-        while True:
-            set_states_new = set_states + [t for s,t in S if s in set_states ]
-            if set(set_states) == set(set_states_new): break
-            set_states = set_states_new
-
-
-        # This is the set of states where the mutation has been deleted. Thus it gets set to be
-        # a two in the output data
-        
-        cells = BC[BC['c'].apply(lambda x: x in set_states)].index
-        T[mut] = T.apply(lambda x: x if x.name not in cells else 2 , axis=1)[mut]
-    return T
+        rows = [state_row[s] for s in descendant_states(S, child)]
+        deleted[rows, columns.get_loc(mut)] = True
 
-def main():
-    BC_file = sys.argv[1]
-    SL_file = sys.argv[2]
-    output_file = sys.argv[3]
+    cell_states = counts.states[counts.cells.get_indexer(B.index)]
+    T = B.values.copy()
+    T[deleted[[state_row[s] for s in cell_states]]] = 2
+    return pd.DataFrame(T, index = B.index, columns = B.columns)
+
+def add_solve_arguments(parser):
+    """
+    adds the options of the optimization, passed on to run_scarlet by solve_options
+    """
+    parser.add_argument('--jobs', type = int, default = 1,
+                        help = 'number of processes used to optimize sigma (default: 1)')
+    parser.add_argument('--solver', choices = sorted(SOLVERS), default = 'gurobi',
+                        help = 'ILP solver used for the mutation matrix (default: gurobi)')
+    parser.add_argument('--lazy-constraints', action = 'store_true',
+                        help = 'only add three-gamete constraints for pairs of mutations that conflict')
+    parser.add_argument('--decompose', action = 'store_true',
+                        help = 'fix trivial and merge identical mutations, and solve independent groups of mutations separately')
+    parser.add_argument('--warm-start', action = 'store_true',
+                        help = 'start the ILP solver from the heuristic solution of --mode fast')
+    parser.add_argument('--mode', choices = ['exact', 'fast'], default = 'exact',
+                        help = 'solve the ILP (exact), or use a polynomial-time heuristic instead (fast) (default: exact)')
+    parser.add_argument('--report-gap', action = 'store_true',
+                        help = 'with --mode fast, also solve the ILP and report the gap to its objective')
+    parser.add_argument('--threads', type = int, default = None,
+                        help = 'total number of threads shared by the ILP solves of the copy-number states, '
+                               'which then run at the same time (default: one state at a time, solver default threads)')
+    parser.add_argument('--time-limit', type = float, default = None,
+                        help = 'total time in seconds for the ILP solves of all copy-number states, after which '
+                               'the best solution found so far is used (default: no limit)')
+    parser.add_argument('--mip-gap', type = float, default = None,
+                        help = 'relative MIP gap on the objective of the cells at which the ILP solver stops (default: solver default)')
+    parser.add_argument('--cache-dir', default = None,
+                        help = 'directory of a cache of sigma and of the solutions of the copy-number states, '
+                               'reused by later runs whose inputs of these stages did not change (default: no cache)')
+    parser.add_argument('--cache-size', type = float, default = 1024,
+                        help = 'maximum size of the cache in MB, the least recently used entries are removed (default: 1024)')
+
+def solve_options(args):
+    """
+    returns the keyword arguments of run_scarlet for the options of add_solve_arguments
+    """
+    cache = None if args.cache_dir is None else open_cache(args.cache_dir, args.cache_size)
+    return dict(jobs = args.jobs, threads = args.threads, time_limit = args.time_limit,
+                mip_gap = args.mip_gap, solver = args.solver,
+                lazy = args.lazy_constraints, decompose = args.decompose,
+                warm_start = args.warm_start, mode = args.mode, report_gap = args.report_gap,
+                cache = cache)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'SCARLET: loss-supported tumor phylogeny inference')
+    parser.add_argument('BC_file', help = 'read count file')
+    parser.add_argument('SL_file', help = 'copy-number tree file with supported losses')
+    parser.add_argument('output_file', help = 'output prefix')
+    parser.add_argument('--states', default = None,
+                        help = 'copy-number states of the cells (cell_id,c), if the read count file is in the '
+                               'sparse format cell_id,mutation,v,t')
+    parser.add_argument('--chunk-size', type = int, default = None,
+                        help = 'read the read count file in chunks of this many cells instead of all at once, '
+                               'and load the cells of one copy-number state at a time (default: read all at once)')
+    add_solve_arguments(parser)
+    parser.add_argument('--output-format', choices = MATRIX_FORMATS, default = 'csv',
+                        help = 'format of the .B, .B_ancestor and .T files, parquet and npz add their extension (default: csv)')
+    parser.add_argument('--plot', choices = ['ALL', 'COUNT', 'NONE'], type = str.upper, default = None,
+                        help = 'also write the tree as [prefix].edgelist and [prefix].dot, drawing all observed cells (ALL), '
+                               'their number (COUNT) or only the mutation tree (NONE) (default: no tree)')
+    parser.add_argument('--render', action = 'store_true',
+                        help = 'with --plot, render the tree to [prefix].pdf with GraphViz, if installed')
+    parser.add_argument('--log-level', choices = ['DEBUG', 'INFO', 'WARNING'], type = str.upper, default = 'INFO',
+                        help = 'INFO shows the progress of the optimization, DEBUG also the intermediate '
+                               'matrices (default: INFO)')
+    parser.add_argument('--LL-breakdown', action = 'store_true',
+                        help = 'also write the log-likelihood of every entry of the mutation matrix, '
+                               'and its sums per cell and per mutation')
+    return parser.parse_args()
+
+###
+#   Library entry point. Runs the whole inference on read counts in memory and returns
+#   the results, without writing any files.
+###
+ScarletResult = namedtuple('ScarletResult', ['B', 'ternary', 'B_ancestor', 'sigma', 'deletions', 'LL', 'LLs',
+                                             'solve_reports', 'timings', 'metrics'])
+
+def run_scarlet(counts, state_tree, losses, jobs=1, chunks=None, cache=None, LL_breakdown=True, **options):
+    """
+    counts -- fileio.ReadCounts, or a dataframe in the format of the read count file
+              (see fileio.read_counts_from_dataframe)
+    state_tree -- edge list of the copy-number tree
+    losses -- dict from every edge (parent, child) of state_tree to the list of its supported losses
+    jobs -- number of processes used to optimize sigma
+    chunks -- for inputs that do not fit in memory, a function returning a new iterable of
+              ReadCounts of chunks of the cells every time it is called, e.g. a partial of
+              fileio.iter_read_counts. counts is then ignored and can be None. The file is
+              read once for sigma, while its cells are split by copy-number state into
+              temporary files, and once more for the log-likelihood
+    cache -- cache.DiskCache (see cache.open_cache) that sigma and the solutions of the
+             copy-number states are taken from if their inputs are unchanged, and stored in
+    LL_breakdown -- if False, LLs is None and, with chunks, the log-likelihood is summed
+                    chunk by chunk without keeping the matrix of all cells
+    options -- keyword arguments of optimize_mutation_matrix.solve_models (threads, time_limit)
+               and solve_model (solver, lazy, decompose, warm_start, mode, report_gap, mip_gap)
+
+    returns ScarletResult with the mutation matrix B, the ternary matrix, the mutation matrix with
+    ancestors B_ancestor, sigma, the list of deletions, the log-likelihood LL of B and the matrix
+    LLs of compute_LL_matrix, the solve_reports of the copy-number states, the wall time of every
+    stage in timings and all metrics of the stages from metrics.get_metrics
 
-    BC, S, L = read_in_files(BC_file, SL_file)
-    mutations = sorted(set([v.split('_')[0] for v in BC.columns[1:]]))
-    sigmas, dels = get_optimal_sigma(S,BC,L)
-    DPs = get_descendent_profiles(sigmas, mutations, S, L)
+    Progress is logged to the logging module at levels INFO and DEBUG.
+    """
+    S = [list(map(int, edge)) for edge in state_tree]
+    L = {tuple(map(int, edge)): list(losses.get(tuple(edge), [])) for edge in S}
+    if isinstance(counts, pd.DataFrame):
+        counts = read_counts_from_dataframe(counts)
+
+    reset_metrics()
+    with stage('sigma'):
+        if chunks is not None:
+            # only the per-state sums of sigma are kept, and counts has no read counts
+            spill = tempfile.TemporaryDirectory(prefix = 'scarlet-')
+            state_files = {}
+            counts, state_LLs = stream_state_log_likelihoods(split_state_counts(chunks(), spill.name, state_files))
+            state_LLs_key = hash_key(state_LLs) if cache is not None else None
+        else:
+            # the per-state sums only depend on the read counts, not on the tree or the losses
+            state_LLs_parts = ('state log-likelihoods', counts.V, counts.T, counts.states)
+            state_LLs_key = hash_key(*state_LLs_parts) if cache is not None else None
+            if jobs == 1:
+                state_LLs = cached(cache, state_LLs_parts, lambda: get_state_log_likelihoods(
+                    counts.V, counts.T, counts.states, len(set(counts.states))))
+            else:
+                # the processes of get_optimal_sigma compute them for their own mutations
+                state_LLs = None
+        mutations = list(counts.mutations)
+        sigmas, dels = cached(cache, ('sigma', state_LLs_key, mutations, S, L),
+                              lambda: get_optimal_sigma(S,counts,L, jobs = jobs, state_LLs = state_LLs))
+
+    with stage('descendant profiles'):
+        DPs = get_descendent_profiles(sigmas, mutations, S, L)
 
     all_deletions = dels
-    cn_states = BC['c'].unique()
-    Bs = {}
+    cn_states = pd.unique(counts.states)
+    Cs = {}
     for i in cn_states:
 
-        C= calculate_C(i, sigmas, DPs, BC)
+        with stage('C'):
+            state_counts = load_state_counts(state_files[i], i, counts.mutations) if chunks is not None else counts
+            Cs[i] = calculate_C(i, sigmas, DPs, state_counts)
+    if chunks is not None:
+        spill.cleanup()
 
-        B, deletions = solve_model(C)
+    reports = {}
+    with stage('solve'):
+        solutions = solve_models(Cs, reports = reports, cache = cache, **options)
+    Bs = {}
+    for i in cn_states:
+        B, deletions = solutions[i]
         Bs[i]=B
         all_deletions += deletions
 
-    print("All DELETIONS", all_deletions)
+    logger.info("All DELETIONS {}".format(all_deletions))
+
+    with stage('assembly'):
+        result = assemble_mutation_matrix(Bs, sigmas, counts, mutations)
+        result_with_ancestors = assemble_mutation_matrix_with_ancestors(Bs, sigmas, counts, mutations)
 
+    with stage('ternary'):
+        ternary = correct_ternary_matrix(result, S, counts, all_deletions)
+
+    with stage('LL'):
+        if chunks is not None and LL_breakdown:
+            LLs = pd.concat([compute_LL_matrix(chunk, result.loc[chunk.cells], mutations) for chunk in chunks()])
+            solutionLL = LLs.values.sum()
+        elif chunks is not None:
+            LLs = None
+            solutionLL = sum(compute_LL_solution(chunk, result.loc[chunk.cells], mutations) for chunk in chunks())
+        elif LL_breakdown:
+            solutionLL, LLs = compute_LL_solution(counts, result, mutations, return_matrix = True)
+        else:
+            LLs = None
+            solutionLL = compute_LL_solution(counts, result, mutations)
+
+    metrics = get_metrics()
+    timings = {name: metrics[name]['wall_time'] for name in metrics}
+    return ScarletResult(B = result, ternary = ternary, B_ancestor = result_with_ancestors, sigma = sigmas,
+                         deletions = all_deletions, LL = solutionLL, LLs = LLs, solve_reports = reports,
+                         timings = timings, metrics = metrics)
+
+def write_result(result, output_file, output_format = 'csv', load_metrics = None, options_hash = None):
+    """
+    writes the .B, .B_ancestor, .T, .LL, .solve_report and .metrics.json files of the
+    ScarletResult result, with the metrics of loading the input in load_metrics and the
+    hash of the options of the run in options_hash if given. The .metrics.json file is
+    written last
+    """
+    write_out_files(result.B, result.B_ancestor, result.ternary, output_file, result.LL, output_format)
+    write_solve_report(result.solve_reports, output_file)
+    write_metrics(dict(load_metrics or {}, **result.metrics), result.solve_reports, output_file, options_hash)
+
+def main():
+    args = parse_arguments()
+    BC_file = args.BC_file
+    SL_file = args.SL_file
+    output_file = args.output_file
+    logging.basicConfig(level = args.log_level, format = '%(message)s', stream = sys.stdout)
 
-    result = assemble_mutation_matrix(Bs, sigmas, BC, mutations)
-    result_with_ancestors = assemble_mutation_matrix_with_ancestors(Bs, sigmas, BC, mutations)
+    reset_metrics()
+    if args.chunk_size is not None:
+        if args.states is not None:
+            raise ValueError('--chunk-size is only supported for the dense read count format')
+        counts = None
+        chunks = partial(iter_read_counts, BC_file, args.chunk_size)
+        S, L = read_state_tree(SL_file)
+    else:
+        with stage('load'):
+            counts, S, L = read_in_files(BC_file, SL_file, args.states)
+        chunks = None
+    # run_scarlet starts its own metrics
+    load_metrics = get_metrics()
 
-    ternary = result.copy()
-    for deletion in all_deletions:
-        ternary = correct_ternary_matrix(ternary, S, BC, all_deletions)
+    result = run_scarlet(counts, S, L, chunks = chunks, LL_breakdown = args.LL_breakdown, **solve_options(args))
 
+    write_result(result, output_file, args.output_format, load_metrics)
+    if args.LL_breakdown:
+        write_LL_breakdown(result.LLs, output_file)
 
-    solutionLL = compute_LL_solution(BC, result, mutations)
-    write_out_files(result, result_with_ancestors, ternary, output_file, solutionLL)
+    if args.plot is not None:
+        dot_file = write_tree_files(result.B_ancestor, S, output_file, args.plot)
+        if args.render:
+            render_dot_file(dot_file, '{}.pdf'.format(output_file))
 
 
 
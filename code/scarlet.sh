@@ -16,8 +16,4 @@ fi
 
 DIR="$( cd "$( dirname "${BASH_SOURCE[0]}" )" >/dev/null 2>&1 && pwd )"
 
-python $DIR/scarlet.py $readcount_file $cntree_file $output_prefix
-
-python $DIR/plot_tree.py ${output_prefix}.B_ancestor $cntree_file $plotting_style $output_prefix 
-
-dot -Tpdf ${output_prefix}.dot -o ${output_prefix}.pdf -v
+python $DIR/scarlet.py $readcount_file $cntree_file $output_prefix --plot $plotting_style --render
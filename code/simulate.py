@@ -0,0 +1,190 @@
+###
+#   Generator of synthetic SCARLET inputs of any size, for stress-testing. Takes a
+#   copy-number tree with supported losses (the format of data/simulations/perfect_data/tree.*.S,
+#   which is also the copy-number tree file of SCARLET) and
+#       1. assigns the cells to the copy-number states uniformly at random
+#       2. gains every mutation in a random state, where it is placed in a random tree of
+#          the mutations gained in that state. Cells and the founders of the child states
+#          hang from random vertices of that tree, so every state has a perfect phylogeny.
+#          The mutations with supported losses are instead truncal, present in the founder
+#          of the root state, as otherwise they would rarely be in the founder of the state
+#          where they can be lost
+#       3. passes the mutations of the founder of a child state on to the child, except that
+#          a mutation in the supported losses of the edge is lost with probability loss_prob
+#       4. samples read counts with the model of probmodels: the total read count is 0 with
+#          probability dropout and Poisson(depth) otherwise, and the variant read count is
+#          Binomial(t, PROB_SEQ_ERROR) if the mutation is absent and
+#          BetaBinomial(t, BETABINOM_ALPHA, BETABINOM_BETA) if it is present
+#
+#   The output has the layout of data/simulations, so it can be run with
+#   benchmark.py --data-dir:
+#       [output dir]/scarlet_input/tree.[i].B               read count file
+#       [output dir]/perfect_data/tree.[i].B, tree.[i].T    ground truth, a line with the number of
+#                                                           cells, one with the number of mutations
+#                                                           and the space-separated matrix
+#       [output dir]/perfect_data/tree.[i].S                the copy-number tree
+#
+#   The mutations of the supported losses keep their names and the other mutations are
+#   named m0, m1, ...
+#
+#   USAGE: python code/simulate.py [copy-number tree file] [output dir] [options]
+###
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from fileio import read_state_tree
+from probmodels import PROB_SEQ_ERROR, BETABINOM_ALPHA, BETABINOM_BETA
+
+def random_tree(num_vertices, rng):
+    """
+    returns array of the parent of every vertex of a random recursive tree, where vertex 0 is
+    the root (parent -1) and every other vertex hangs from a uniformly random earlier vertex
+    """
+    parent = np.full(num_vertices, -1)
+    if num_vertices > 1:
+        parent[1:] = (rng.random(num_vertices - 1) * np.arange(1, num_vertices)).astype(int)
+    return parent
+
+def simulate_phylogeny(S, L, num_cells, num_mutations, loss_prob, rng):
+    """
+    S -- edge list of the copy-number tree, with states 0, ..., k-1
+    L -- dict from every edge to its list of supported losses
+
+    returns (states, B, T, mutations) where states is the copy-number state of every cell,
+    B is the binary mutation matrix (cells x mutations), T the ternary matrix and
+    mutations the list of the mutation names
+    """
+    num_states = max(max(edge) for edge in S) + 1 if len(S) > 0 else 1
+    children = {s: [] for s in range(num_states)}
+    for s, t in S:
+        children[s].append(t)
+    has_parent = set(t for s, t in S)
+    root = [s for s in range(num_states) if s not in has_parent][0]
+
+    loss_names = sorted(set(a for edge in L for a in L[edge]))
+    if len(loss_names) > num_mutations:
+        raise ValueError('The tree has {} mutations with supported losses, more than {} mutations'.format(
+            len(loss_names), num_mutations))
+    mutations = loss_names + ['m{}'.format(j) for j in range(num_mutations - len(loss_names))]
+    column = {a: j for j, a in enumerate(mutations)}
+
+    # every state gets at least one cell
+    states = np.concatenate([np.arange(min(num_states, num_cells)),
+                             rng.integers(0, num_states, max(num_cells - num_states, 0))])
+    rng.shuffle(states)
+    gain_state = rng.integers(0, num_states, num_mutations)
+    gain_state[:len(loss_names)] = -1
+
+    B = np.zeros((num_cells, num_mutations), dtype=np.int8)
+    T = np.zeros((num_cells, num_mutations), dtype=np.int8)
+    founder = {root: gain_state == -1}
+    lost = {root: np.zeros(num_mutations, dtype=bool)}
+    stack = [root]
+    while len(stack) > 0:
+        s = stack.pop()
+        gained = np.nonzero(gain_state == s)[0]
+
+        # vertex 0 is the founder of s and vertex i > 0 has mutation gained[i-1]
+        parent = random_tree(len(gained) + 1, rng)
+        paths = np.zeros((len(gained) + 1, num_mutations), dtype=bool)
+        paths[0] = founder[s]
+        for i in range(1, len(gained) + 1):
+            paths[i] = paths[parent[i]]
+            paths[i, gained[i - 1]] = True
+
+        cells = np.nonzero(states == s)[0]
+        B[cells] = paths[rng.integers(0, len(gained) + 1, len(cells))]
+        T[cells] = np.where(lost[s], 2, B[cells])
+
+        for t in children[s]:
+            profile = paths[rng.integers(0, len(gained) + 1)].copy()
+            supported = np.zeros(num_mutations, dtype=bool)
+            supported[[column[a] for a in L.get((s, t), [])]] = True
+            losses = profile & supported & (rng.random(num_mutations) < loss_prob)
+            founder[t] = profile & ~losses
+            lost[t] = lost[s] | losses
+            stack.append(t)
+
+    return states, B, T, mutations
+
+def simulate_read_counts(B, depth, dropout, rng):
+    """
+    returns (V, T) arrays of variant and total read counts for the mutation matrix B
+    """
+    T = rng.poisson(depth, B.shape)
+    T[rng.random(B.shape) < dropout] = 0
+    vaf = np.where(B == 1, rng.beta(BETABINOM_ALPHA, BETABINOM_BETA, B.shape), PROB_SEQ_ERROR)
+    V = rng.binomial(T, vaf)
+    return V, T
+
+def write_read_counts(states, V, T, mutations, filename, chunksize = 10000):
+    """
+    writes the read count file, in chunks of cells so that the table of strings is never
+    built for all cells at once
+    """
+    columns = ['c'] + ['{}_{}'.format(a, x) for a in mutations for x in ['v', 't']]
+    counts = np.empty((V.shape[0], 2 * V.shape[1]), dtype = V.dtype)
+    counts[:, 0::2] = V
+    counts[:, 1::2] = T
+    with open(filename, 'w') as out:
+        for start in range(0, len(states), chunksize):
+            end = min(start + chunksize, len(states))
+            chunk = pd.DataFrame(np.column_stack([states[start:end], counts[start:end]]),
+                                 index = np.arange(start, end), columns = columns)
+            chunk.to_csv(out, header = start == 0)
+
+def write_ground_truth(M, filename):
+    """
+    writes the matrix M with entries in 0-9 in the format of data/simulations/perfect_data
+    """
+    n, m = M.shape
+    # the digits of a row separated by spaces, built as bytes
+    line = np.full((n, 2 * m), ord(' '), dtype=np.uint8)
+    line[:, 0::2] = M + ord('0')
+    line[:, -1] = ord('\n')
+    with open(filename, 'wb') as out:
+        out.write('{}\n{}\n'.format(n, m).encode())
+        out.write(line.tobytes())
+
+def write_state_tree(S, L, filename):
+    with open(filename, 'w') as out:
+        for s, t in S:
+            out.write(','.join(map(str, [s, t] + L.get((s, t), []))) + '\n')
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description = 'Generate synthetic SCARLET inputs with ground truth')
+    parser.add_argument('SL_file', help = 'copy-number tree file with supported losses')
+    parser.add_argument('output_dir', help = 'directory for scarlet_input/ and perfect_data/')
+    parser.add_argument('--cells', type = int, default = 10000, help = 'number of cells (default: 10000)')
+    parser.add_argument('--mutations', type = int, default = 1000, help = 'number of mutations (default: 1000)')
+    parser.add_argument('--depth', type = float, default = 100, help = 'mean total read count (default: 100)')
+    parser.add_argument('--dropout', type = float, default = 0.0,
+                        help = 'probability that a cell has no reads for a mutation (default: 0)')
+    parser.add_argument('--loss-prob', type = float, default = 0.5,
+                        help = 'probability that a supported loss of a mutation in the founder of a state happens (default: 0.5)')
+    parser.add_argument('--instances', type = int, default = 1, help = 'number of instances (default: 1)')
+    parser.add_argument('--seed', type = int, default = 0, help = 'random seed (default: 0)')
+    return parser.parse_args()
+
+def main():
+    args = parse_arguments()
+    S, L = read_state_tree(args.SL_file)
+    rng = np.random.default_rng(args.seed)
+    for directory in ['scarlet_input', 'perfect_data']:
+        os.makedirs(os.path.join(args.output_dir, directory), exist_ok = True)
+
+    for i in range(args.instances):
+        states, B, T, mutations = simulate_phylogeny(S, L, args.cells, args.mutations, args.loss_prob, rng)
+        V, T_reads = simulate_read_counts(B, args.depth, args.dropout, rng)
+
+        prefix = os.path.join(args.output_dir, 'perfect_data', 'tree.{}'.format(i))
+        write_read_counts(states, V, T_reads, mutations, os.path.join(args.output_dir, 'scarlet_input', 'tree.{}.B'.format(i)))
+        write_ground_truth(B, '{}.B'.format(prefix))
+        write_ground_truth(T, '{}.T'.format(prefix))
+        write_state_tree(S, L, '{}.S'.format(prefix))
+        print('Instance {}: {} cells, {} mutations, {} lost entries'.format(i, len(states), len(mutations), (T == 2).sum()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,299 @@
+###
+#   ILP backends for the perfect phylogeny problem solved by
+#   optimize_mutation_matrix.solve_model. Every backend takes the score matrix C
+#   and returns the optimal binary matrix B with the same index and columns.
+###
+import pandas as pd
+import numpy as np
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    from gurobipy import Env, Model, GRB, GurobiError
+except ImportError:
+    Model = None
+
+from scipy.optimize import milp, LinearConstraint, Bounds
+from scipy.sparse import coo_matrix, csr_matrix, hstack
+
+from metrics import stage
+
+logger = logging.getLogger(__name__)
+
+###
+#   Builds the ILP as a sparse constraint matrix A and objective c, maximizing
+#   c x subject to A x <= rhs with x binary.
+#
+#   With n cells, m mutations and P mutation pairs (all m(m-1)/2 by default) the variables are
+#   laid out as
+#       b_{p,a}     p*m + a                             the mutation matrix B
+#       x,y,z_k     n*m + 3*k + {0,1,2}                 pair k has gamete (1,1), (0,1), (1,0)
+#       x,y,z_{p,k} n*m + 3*P + 3*(k*n + p) + {0,1,2}   cell p has that gamete on pair k
+#   and no pair may have all three gametes.
+###
+def build_model_matrices(C, pairs = None):
+    """
+    C -- pandas dataframe with columns correspondng to mutations and rows corresponding to cells
+    pairs -- (a, b) arrays of the column pairs that get three-gamete constraints, all
+             pairs if None
+
+    returns (c, A, rhs) where c and rhs are arrays and A is a scipy.sparse csr matrix
+    """
+    n, m = C.shape
+    if pairs is None:
+        pair_a, pair_b = np.triu_indices(m, 1)
+    else:
+        pair_a, pair_b = pairs
+    num_pairs = len(pair_a)
+    num_vars = n*m + 3*num_pairs + 3*num_pairs*n
+
+    c = np.zeros(num_vars)
+    c[:n*m] = C.values.ravel()
+
+    rows, cols, vals, rhs = [], [], [], []
+    def add_rows(terms, bound):
+        # terms is a list of (row, variable, coefficient) where row and variable
+        # are arrays of the same length, row numbering the new constraints
+        start = sum(len(r) for r in rhs)
+        for row, variables, coef in terms:
+            rows.append(start + row)
+            cols.append(variables)
+            vals.append(np.full(len(variables), coef, dtype=float))
+        rhs.append(np.full(max(row.max() for row, _, _ in terms) + 1, bound, dtype=float))
+
+    if num_pairs > 0:
+        # one entry e for every pair k and cell p
+        e = np.arange(num_pairs*n)
+        k, p = np.divmod(e, n)
+        b_a = p*m + pair_a[k]
+        b_b = p*m + pair_b[k]
+        x_p = n*m + 3*num_pairs + 3*e
+        y_p = x_p + 1
+        z_p = x_p + 2
+
+        # x_p, y_p and z_p are the products b_a b_b, (1-b_a) b_b and b_a (1-b_b)
+        add_rows([(e, x_p, -1), (e, b_a, 1), (e, b_b, 1)], 1)
+        add_rows([(e, y_p, -1), (e, b_a, -1), (e, b_b, 1)], 0)
+        add_rows([(e, z_p, -1), (e, b_a, 1), (e, b_b, -1)], 0)
+        add_rows([(e, x_p, 1), (e, b_a, -1)], 0)
+        add_rows([(e, x_p, 1), (e, b_b, -1)], 0)
+        add_rows([(e, y_p, 1), (e, b_a, 1)], 1)
+        add_rows([(e, y_p, 1), (e, b_b, -1)], 0)
+        add_rows([(e, z_p, 1), (e, b_a, -1)], 0)
+        add_rows([(e, z_p, 1), (e, b_b, 1)], 1)
+
+        # x, y and z are the or of x_p, y_p and z_p over all cells
+        pair = np.arange(num_pairs)
+        x = n*m + 3*pair
+        for offset in range(3):
+            add_rows([(e, x_p + offset, 1), (e, x[k] + offset, -1)], 0)
+            add_rows([(pair, x + offset, 1), (k, x_p + offset, -1)], 0)
+
+        add_rows([(pair, x, 1), (pair, x + 1, 1), (pair, x + 2, 1)], 2)
+
+    if len(rhs) > 0:
+        rhs = np.concatenate(rhs)
+        A = coo_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                       shape = (len(rhs), num_vars)).tocsr()
+    else:
+        rhs = np.zeros(0)
+        A = coo_matrix((0, num_vars)).tocsr()
+    return c, A, rhs
+
+def find_conflicting_pairs(B):
+    """
+    B -- binary matrix (cells x mutations)
+
+    returns (a, b) arrays of the column pairs a < b of B that contain all three gametes
+    (1,1), (0,1) and (1,0), i.e. that violate the perfect phylogeny
+    """
+    B = np.asarray(B, dtype=float)
+    both = B.T.dot(B)
+    only_b = (1 - B).T.dot(B)
+    only_a = B.T.dot(1 - B)
+    conflicts = np.triu((both > 0) & (only_b > 0) & (only_a > 0), 1)
+    return np.nonzero(conflicts)
+
+def add_solver_stats(info, variables, constraints, nodes, models = 1):
+    """
+    adds the statistics of solved models to info: the number of models, the number of
+    variables and constraints of the largest model and the total number of branch-and-bound nodes
+    """
+    info['models'] = info.get('models', 0) + models
+    info['variables'] = max(info.get('variables', 0), variables)
+    info['constraints'] = max(info.get('constraints', 0), constraints)
+    info['nodes'] = info.get('nodes', 0) + nodes
+
+###
+#   Started gurobi environments are kept in a pool of the process, so that the license is
+#   checked out once per concurrent solve instead of once per model. Every model checks an
+#   environment out of the pool for its solve and returns it afterwards, so no environment
+#   is used by two threads at the same time, and environments outlive the threads of
+#   optimize_mutation_matrix.solve_models and are reused by later runs in the same
+#   process, e.g. the later jobs of a batch.py worker.
+###
+_ENV_POOL = []
+_ENV_LOCK = threading.Lock()
+
+@contextmanager
+def gurobi_env():
+    """
+    yields a started gurobi environment from the pool, or a new one if all are in use
+    """
+    with _ENV_LOCK:
+        env = _ENV_POOL.pop() if len(_ENV_POOL) > 0 else None
+    if env is None:
+        env = Env(empty = True)
+        env.setParam('OutputFlag', 0)
+        env.start()
+    try:
+        yield env
+    finally:
+        with _ENV_LOCK:
+            _ENV_POOL.append(env)
+
+def _solution_to_B(C, x):
+    n, m = C.shape
+    B = pd.DataFrame(np.round(x[:n*m]).reshape(n, m), index = C.index, columns = C.columns)
+    return B
+
+def solve_model_gurobi(C, pairs = None, threads = None, start = None, time_limit = None, mip_gap = None,
+                       offset = 0.0, info = None):
+    """
+    C -- pandas dataframe with columns correspondng to mutations and rows corresponding to cells
+    pairs -- column pairs that get three-gamete constraints, see build_model_matrices
+    threads -- maximum number of threads used by the solver, solver default if None
+    start -- feasible binary matrix with the shape of C used as MIP start, or None
+    time_limit -- time limit in seconds, after which the best solution found is returned
+    mip_gap -- relative MIP gap at which the solve stops, solver default if None
+    offset -- constant subtracted from the objective, so that the MIP gap is relative to
+              the objective minus offset instead of the whole objective
+    info -- dict that gets the 'status' of the solve and the 'bound' on the objective, and
+            the statistics of add_solver_stats
+
+    returns B, the optimal mutation matrix with the same shape as C
+    """
+    if Model is None:
+        raise ImportError('gurobipy is not installed, use the highs solver instead')
+    try:
+        with stage('ILP build'):
+            c, A, rhs = build_model_matrices(C, pairs)
+
+        with gurobi_env() as env:
+            # Create a new model in an environment of the pool. The log of gurobi is
+            # shown at log level INFO
+            m = Model("mip1", env = env)
+            try:
+                m.Params.OutputFlag = int(logger.isEnabledFor(logging.INFO))
+                if threads is not None:
+                    m.Params.Threads = threads
+                if time_limit is not None:
+                    m.Params.TimeLimit = max(time_limit, 0)
+                if mip_gap is not None:
+                    m.Params.MIPGap = mip_gap
+                x = m.addMVar(len(c), vtype=GRB.BINARY)
+                if start is not None:
+                    # only B is given, gurobi completes the start for the other variables
+                    values = np.full(len(c), GRB.UNDEFINED)
+                    values[:start.size] = np.ravel(start)
+                    x.Start = values
+                if A.shape[0] > 0:
+                    m.addConstr(A @ x <= rhs)
+
+                # Set objective
+                m.setObjective(c @ x - offset, GRB.MAXIMIZE)
+
+                with stage('ILP solve'):
+                    m.optimize()
+
+                if info is not None:
+                    add_solver_stats(info, len(c), A.shape[0], int(m.NodeCount))
+                    info['status'] = {GRB.OPTIMAL: 'optimal', GRB.TIME_LIMIT: 'time_limit'}.get(m.Status, 'status {}'.format(m.Status))
+                    try:
+                        info['bound'] = m.ObjBound + offset
+                    except GurobiError:
+                        # no bound if the time limit ran out before the root relaxation was solved
+                        info['bound'] = np.inf
+                if m.SolCount == 0:
+                    # the time limit can run out before the MIP start is even loaded
+                    if start is not None:
+                        logger.warning('Gurobi found no solution (status {}), using the start'.format(m.Status))
+                        return pd.DataFrame(np.asarray(start, dtype=float), index = C.index, columns = C.columns)
+                    raise Exception('Gurobi found no solution (status {})'.format(m.Status))
+
+                return _solution_to_B(C, x.X)
+            finally:
+                # the model must be freed before the environment goes back to the pool
+                m.dispose()
+
+    except GurobiError:
+        logger.error('Error reported')
+        raise
+
+
+def solve_model_highs(C, pairs = None, threads = None, start = None, time_limit = None, mip_gap = None,
+                      offset = 0.0, info = None):
+    """
+    Same model as solve_model_gurobi, solved with the HiGHS MILP solver shipped
+    with scipy, which needs no license.
+
+    C -- pandas dataframe with columns correspondng to mutations and rows corresponding to cells
+    pairs -- column pairs that get three-gamete constraints, see build_model_matrices
+    threads -- unused, the MILP solver of HiGHS runs on a single thread
+    start -- feasible binary matrix with the shape of C returned if HiGHS finds no
+             solution. scipy does not pass MIP starts on to HiGHS
+    time_limit -- time limit in seconds, after which the best solution found is returned
+    mip_gap -- relative MIP gap at which the solve stops, solver default if None
+    offset -- constant subtracted from the objective, so that the MIP gap is relative to
+              the objective minus offset instead of the whole objective
+    info -- dict that gets the 'status' of the solve and the 'bound' on the objective, and
+            the statistics of add_solver_stats
+
+    returns B, the optimal mutation matrix with the same shape as C
+    """
+    with stage('ILP build'):
+        c, A, rhs = build_model_matrices(C, pairs)
+    if info is None: info = {}
+    if len(c) == 0:
+        add_solver_stats(info, 0, 0, 0)
+        info['status'] = 'optimal'
+        info['bound'] = 0.0
+        return C.copy()
+
+    # scipy has no objective constant, so the offset is the cost of one more variable
+    # fixed to 1, which HiGHS includes in the objective of its MIP gap
+    num_vars = len(c)
+    c = np.append(c, -offset)
+    lower = np.zeros(len(c))
+    lower[num_vars] = 1
+    A = hstack([A, csr_matrix((A.shape[0], 1))]).tocsr()
+
+    constraints = []
+    if A.shape[0] > 0:
+        constraints.append(LinearConstraint(A, -np.inf, rhs))
+
+    options = {}
+    if time_limit is not None:
+        options['time_limit'] = max(time_limit, 0)
+    if mip_gap is not None:
+        options['mip_rel_gap'] = mip_gap
+
+    # milp minimizes, so the objective and its bound are negated
+    with stage('ILP solve'):
+        result = milp(-c, constraints = constraints, integrality = np.ones(len(c)), bounds = Bounds(lower, 1),
+                      options = options)
+    add_solver_stats(info, num_vars, A.shape[0], int(getattr(result, 'mip_node_count', 0) or 0))
+    info['status'] = {0: 'optimal', 1: 'time_limit'}.get(result.status, 'status {}'.format(result.status))
+    bound = getattr(result, 'mip_dual_bound', None)
+    info['bound'] = np.inf if bound is None else offset - bound
+    if result.x is None:
+        if start is not None:
+            logger.warning('HiGHS found no solution ({}), using the start'.format(result.message))
+            return pd.DataFrame(np.asarray(start, dtype=float), index = C.index, columns = C.columns)
+        raise Exception('HiGHS failed to solve the model: {}'.format(result.message))
+
+    return _solution_to_B(C, result.x)
+
+
+SOLVERS = {'gurobi': solve_model_gurobi, 'highs': solve_model_highs}
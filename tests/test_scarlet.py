@@ -0,0 +1,87 @@
+###
+#   Consistency checks of SCARLET on the bundled data: the alternative algorithms and
+#   input formats must give the same results as the reference ones. The ILPs are solved
+#   with HiGHS, which needs no license, and without MIP gap.
+#
+#   USAGE: python -m pytest tests
+###
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'code')
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data')
+EXAMPLE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'example')
+sys.path.insert(0, CODE_DIR)
+
+from fileio import read_in_files
+from optimize_sigma import get_optimal_sigma
+from optimize_mutation_matrix import get_descendent_profiles, calculate_C, solve_model
+from solvers import find_conflicting_pairs
+from heuristics import greedy_perfect_phylogeny, fast_perfect_phylogeny
+from scarlet import run_scarlet
+
+INSTANCES = [(os.path.join(EXAMPLE_DIR, 'read_counts.csv'), os.path.join(EXAMPLE_DIR, 'tree.csv'))] + \
+            [(os.path.join(DATA_DIR, 'simulations', 'scarlet_input', 'tree.{}.B'.format(i)),
+              os.path.join(DATA_DIR, 'simulations', 'perfect_data', 'tree.{}.S'.format(i))) for i in [0, 7]]
+
+def instance_Cs(BC_file, SL_file):
+    """
+    returns dict from copy-number state to the matrix C of the instance
+    """
+    counts, S, L = read_in_files(BC_file, SL_file)
+    sigmas, _ = get_optimal_sigma(S, counts, L)
+    DPs = get_descendent_profiles(sigmas, list(counts.mutations), S, L)
+    return {i: calculate_C(i, sigmas, DPs, counts) for i in pd.unique(counts.states)}
+
+@pytest.fixture(scope = 'module', params = INSTANCES, ids = lambda instance: os.path.basename(instance[0]))
+def Cs(request):
+    return instance_Cs(*request.param)
+
+def objective(C, B):
+    return (B.values * C.values).sum()
+
+@pytest.mark.parametrize('BC_file,SL_file', INSTANCES + [(os.path.join(DATA_DIR, 'CRC2', 'CRC2.csv'),
+                                                          os.path.join(DATA_DIR, 'CRC2', 'CRC2-L.csv'))])
+def test_sigma_dp_equals_enumerate(BC_file, SL_file):
+    counts, S, L = read_in_files(BC_file, SL_file)
+    sigma_dp, deletions_dp = get_optimal_sigma(S, counts, L, method = 'dp')
+    sigma_enumerate, deletions_enumerate = get_optimal_sigma(S, counts, L, method = 'enumerate')
+    assert sigma_dp.equals(sigma_enumerate)
+    assert sorted(deletions_dp) == sorted(deletions_enumerate)
+
+@pytest.mark.parametrize('lazy,decompose', [(True, False), (False, True), (True, True)])
+def test_lazy_and_decomposed_equal_full_model(Cs, lazy, decompose):
+    for i, C in Cs.items():
+        B_full, _ = solve_model(C, solver = 'highs', mip_gap = 0)
+        B, _ = solve_model(C, solver = 'highs', mip_gap = 0, lazy = lazy, decompose = decompose)
+        assert len(find_conflicting_pairs(B.values)[0]) == 0
+        assert np.isclose(objective(C, B), objective(C, B_full), rtol = 1e-9, atol = 1e-6), i
+
+@pytest.mark.parametrize('heuristic', [greedy_perfect_phylogeny, fast_perfect_phylogeny])
+def test_heuristics_have_no_conflicting_pairs(Cs, heuristic):
+    for i, C in Cs.items():
+        B = heuristic(C.values)
+        assert B.shape == C.shape
+        assert len(find_conflicting_pairs(B)[0]) == 0, i
+
+def test_sparse_input_equals_dense(tmp_path):
+    BC_file, SL_file = INSTANCES[0]
+    BC = pd.read_csv(BC_file, index_col = 0)
+    mutations = sorted(v[:-2] for v in BC.columns if v.endswith('_v'))
+    entries = pd.DataFrame([(cell, a, line['{}_v'.format(a)], line['{}_t'.format(a)])
+                            for cell, line in BC.iterrows() for a in mutations if line['{}_t'.format(a)] > 0],
+                           columns = ['cell_id', 'mutation', 'v', 't'])
+    entries.to_csv(tmp_path / 'read_counts.long.csv', index = False)
+    BC[['c']].to_csv(tmp_path / 'states.csv', index_label = 'cell_id')
+
+    dense, S, L = read_in_files(BC_file, SL_file)
+    sparse, _, _ = read_in_files(str(tmp_path / 'read_counts.long.csv'), SL_file, str(tmp_path / 'states.csv'))
+    result_dense = run_scarlet(dense, S, L, solver = 'highs', mip_gap = 0)
+    result_sparse = run_scarlet(sparse, S, L, solver = 'highs', mip_gap = 0)
+    assert np.isclose(result_sparse.LL, result_dense.LL, rtol = 1e-12)
+    assert result_sparse.B.equals(result_dense.B)
+    assert result_sparse.ternary.equals(result_dense.ternary)